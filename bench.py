@@ -0,0 +1,253 @@
+#!/usr/bin/python
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Benchmark the frame pipeline of videomaker on synthetic pictures
+"""
+
+import argparse
+import json
+import logging
+import os.path
+import platform
+import random
+import shutil
+import tempfile
+import time
+
+import PIL
+from PIL import Image
+
+import info
+import videomaker
+
+
+METHODS = {'nearest': Image.NEAREST,
+           'bilinear': Image.BILINEAR,
+           'bicubic': Image.BICUBIC,
+           'lanczos': Image.LANCZOS,
+           }
+
+
+def make_pictures(path, count, size, seed=0, fmt='JPEG'):
+    """
+    Generate a folder of reproducible synthetic pictures
+
+    :param path: destination directory
+    :param count: number of pictures
+    :param size: picture size
+    :param seed: random seed
+    :param fmt: file format (JPEG or PNG)
+    :returns: list of paths
+    """
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    ext = {'JPEG': '.jpg', 'PNG': '.png'}[fmt]
+    # A gradient with some noise: compresses like a photograph, not like a flat image
+    base = Image.radial_gradient('L').resize(size).convert('RGB')
+    pictures = []
+    for i in range(count):
+        # effect_noise ignores the seed
+        noise = Image.frombytes('L', size, rng.randbytes(size[0] * size[1])).convert('RGB')
+        color = Image.new('RGB', size, tuple(rng.randrange(256) for c in range(3)))
+        im = Image.blend(Image.blend(base, color, 0.5), noise, 0.2)
+        filename = os.path.join(path, 'pic%d%s' % (i, ext))
+        im.save(filename, format=fmt)
+        pictures.append(filename)
+    return pictures
+
+
+def timeit(func, *args, repeat=3, **kwargs):
+    """
+    Best wall time of `repeat` calls
+
+    :param func: function to time
+    :returns: seconds
+    """
+    best = None
+    for rep in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_add_bg(pictures, resolution, repeat=3):
+    """
+    Time add_bg for each resampling method
+
+    :returns: dict method -> seconds per frame
+    """
+    images = [Image.open(item) for item in pictures]
+    for im in images:
+        im.load()
+    bg = Image.new('RGB', resolution, color=(0, 0, 0))
+    results = {}
+    for name, method in METHODS.items():
+        def run():
+            for im in images:
+                videomaker.add_bg(im, bg, method=method)
+        results[name] = timeit(run, repeat=repeat) / len(images)
+    return results
+
+
+def bench_populate(path, resolution, count, tmp_dir, repeat=3, jobs=1, mode='files'):
+    """
+    Time populate_with_pictures in the duplicate (number >= 1) and in the
+    pick (number < 1) branches
+
+    :returns: dict branch -> seconds per source picture
+    """
+    results = {}
+    for branch, number in (('duplicate', 2.5), ('pick', 0.5)):
+        def run():
+            vid = videomaker.Video(resolution, tmp_dir=tmp_dir, mode=mode, jobs=jobs)
+            vid.populate_with_pictures(path, number, 1, Image.BICUBIC)
+            del vid
+        results[branch] = timeit(run, repeat=repeat) / count
+    return results
+
+
+def bench_frame_formats(pictures, resolution, tmp_dir, repeat=3):
+    """
+    Time the writing of frames in each intermediate format
+
+    :returns: dict format -> seconds and bytes per frame
+    """
+    bg = Image.new('RGB', resolution)
+    frames = [videomaker.add_bg(Image.open(item), bg) for item in pictures]
+    results = {}
+    for frame_format in videomaker.FRAME_FORMATS:
+        path = tempfile.mkdtemp(dir=tmp_dir, prefix='frames')
+        sink = videomaker.PictureDirSink(path, frame_format=frame_format,
+                                         resolution=resolution)
+
+        def run():
+            for frame in frames:
+                sink.add(frame)
+        seconds = timeit(run, repeat=repeat) / len(frames)
+        nbytes = sum(entry.stat().st_size for entry in os.scandir(path)) / sink.nb_frames
+        results[frame_format] = {'write': seconds, 'bytes': nbytes}
+        shutil.rmtree(path)
+    return results
+
+
+def bench_sorting(nb_files, tmp_dir, repeat=3):
+    """
+    Time name_it and the natural sort of a large directory
+
+    :returns: dict -> seconds
+    """
+    path = tempfile.mkdtemp(dir=tmp_dir, prefix='sort')
+    generator = videomaker.name_it(path)
+
+    def names():
+        for i in range(nb_files):
+            next(generator)
+    results = {'name_it': timeit(names, repeat=repeat)}
+
+    for i in range(nb_files):
+        open(os.path.join(path, 'img_%d.jpg' % i), 'w').close()
+    results['listdir_sort'] = timeit(lambda: sorted(os.listdir(path),
+                                                    key=videomaker.alphanum_key),
+                                     repeat=repeat)
+    shutil.rmtree(path)
+    return results
+
+
+def bench_encode(path, resolution, count, tmp_dir, mode='files'):
+    """
+    Time the encoding of a populated video
+
+    :returns: dict -> seconds per output frame, None without ffmpeg
+    """
+    if shutil.which('ffmpeg') is None:
+        return None
+    vid = videomaker.Video(resolution, tmp_dir=tmp_dir, mode=mode)
+    vid.populate_with_pictures(path, 2, 1, Image.BICUBIC)
+    dests = [os.path.join(vid.tmp_dir, 'bench%d.%s' % (i, videomaker.rendition_extension(r)))
+             for i, r in enumerate(vid.renditions)]
+    start = time.perf_counter()
+    vid.encode(dests, resolution, 25)
+    return {'encode': (time.perf_counter() - start) / (2 * count)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the frame pipeline',
+                                     epilog='Results are written as JSON')
+    parser.add_argument('-n', '--count', type=int, default=20,
+                        help='Number of synthetic pictures')
+    parser.add_argument('-s', '--size', type=int, nargs=2, default=(3000, 2000),
+                        metavar=('W', 'H'), help='Size of the synthetic pictures')
+    parser.add_argument('-r', '--resolution', type=int, nargs=2, default=(1200, 800),
+                        metavar=('W', 'H'), help='Movie resolution')
+    parser.add_argument('-f', '--format', default='JPEG', choices=('JPEG', 'PNG'),
+                        help='Format of the synthetic pictures')
+    parser.add_argument('--sort-files', type=int, default=10000,
+                        help='Number of files in the sorting benchmark')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of runs, the best one is kept')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes compositing pictures')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('-t', '--tmp', metavar='TMP', default=None,
+                        help='Directory where are stored tmp files')
+    parser.add_argument('-o', '--output', metavar='JSON', default=None,
+                        help='Result file, stdout by default')
+    parser.add_argument('--no-encode', action='store_true', default=False,
+                        help='Skip the encoding benchmark')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    tmp_dir = tempfile.mkdtemp(dir=args.tmp, prefix='bench')
+    try:
+        path = os.path.join(tmp_dir, 'pictures')
+        pictures = make_pictures(path, args.count, tuple(args.size), seed=args.seed,
+                                 fmt=args.format)
+        results = {'meta': {'videomaker': info.VERSION,
+                            'pillow': PIL.__version__,
+                            'python': platform.python_version(),
+                            'machine': platform.machine(),
+                            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                            },
+                   'params': {'count': args.count,
+                              'size': args.size,
+                              'aspect_ratio': args.size[0] / args.size[1],
+                              'resolution': args.resolution,
+                              'format': args.format,
+                              'jobs': args.jobs,
+                              'seed': args.seed,
+                              },
+                   }
+        resolution = tuple(args.resolution)
+        results['add_bg'] = bench_add_bg(pictures, resolution, repeat=args.repeat)
+        results['populate'] = bench_populate(path, resolution, args.count, tmp_dir,
+                                             repeat=args.repeat, jobs=args.jobs)
+        results['frame_formats'] = bench_frame_formats(pictures, resolution, tmp_dir,
+                                                       repeat=args.repeat)
+        results['sorting'] = bench_sorting(args.sort_files, tmp_dir, repeat=args.repeat)
+        if not args.no_encode:
+            results['encode'] = bench_encode(path, resolution, args.count, tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if args.output:
+        with open(args.output, 'w') as jsonfile:
+            json.dump(results, jsonfile, indent=4)
+    else:
+        print(json.dumps(results, indent=4))
@@ -0,0 +1,47 @@
+"""
+Preview of a folder holding a palette picture
+"""
+
+import os.path
+
+from PIL import Image
+
+import videomaker
+
+
+def make_folder(path):
+    """
+    Pictures larger than the preview: a palette GIF between two RGB pictures
+    """
+    os.makedirs(path)
+    base = Image.radial_gradient('L').resize((800, 600)).convert('RGB')
+    base.save(os.path.join(path, 'pic1.png'))
+    base.convert('P', palette=Image.ADAPTIVE).save(os.path.join(path, 'pic2.gif'))
+    base.save(os.path.join(path, 'pic3.png'))
+
+
+def test_reduced_decoding_of_a_palette_picture(tmp_path):
+    make_folder(str(tmp_path / 'pictures'))
+    item = str(tmp_path / 'pictures' / 'pic2.gif')
+    assert Image.open(item).mode == 'P'
+    for decode in ('quality', 'fast'):
+        frame = videomaker.composite(item, (320, 240), decode=decode)
+        assert frame.size == (320, 240)
+        assert frame.mode == 'RGB'
+
+
+def test_preview_of_a_palette_picture(tmp_path):
+    make_folder(str(tmp_path / 'pictures'))
+    config = {'output': 'movie',
+              'resolution': (1200, 800),
+              'renditions': videomaker.RENDITIONS,
+              'root_dir': str(tmp_path),
+              'data': {'body': {'type': 'image', 'path': 'pictures', 'inifps': 1,
+                                'speed': 1, 'repeat': 1}}}
+    preview = videomaker.preview_config(config)
+    fps = videomaker.PREVIEW['fps']
+    vid = videomaker.Video(preview['resolution'], tmp_dir=str(tmp_path), fps=fps,
+                           frame_format=videomaker.PREVIEW['frame_format'])
+    videomaker.populate(vid, preview['data']['body'], preview['root_dir'], fps=fps,
+                        method=videomaker.PREVIEW['method'])
+    assert vid.sink.nb_frames == 3 * fps
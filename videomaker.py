@@ -23,316 +23,3772 @@ import shutil
 import argparse
 import logging
 import math
-from PIL import Image
+import collections
+import concurrent.futures
+import hashlib
+import json
+import threading
+import errno
+import fractions
+import functools
+import itertools
+import mmap
+import multiprocessing
+import socket
+import sqlite3
+import contextlib
+import datetime
+import resource
+import sys
+import time
+from PIL import Image, ImageDraw, ImageFont
+
+
+logger = logging.getLogger(__name__)
+
+
+class Profiler():
+    """
+    Record wall time, CPU time, frames, bytes and peak RSS of nested stages
+
+    Stages are identified by their path ("build;body1;decode"), which is
+    also the collapsed stack format used by flamegraph tools.
+
+    :param progress: print a live frames per second line on stderr
+    """
+    def __init__(self, progress=False):
+        self.progress = progress
+        self.stages = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start = time.perf_counter()
+        self.frames = 0
+        self.last_progress = 0
+
+    def _stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def path(self):
+        """
+        Path of the current stage in this thread
+
+        :returns: string
+        """
+        return ';'.join(self._stack())
+
+    @staticmethod
+    def _cpu():
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return time.process_time() + children.ru_utime + children.ru_stime
+
+    def _record(self, path):
+        with self.lock:
+            if path not in self.stages:
+                self.stages[path] = {'calls': 0, 'wall': 0., 'cpu': 0.,
+                                     'frames': 0, 'bytes': 0, 'peak_rss_kb': 0}
+            return self.stages[path]
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Context manager measuring a stage, nested in the current one
+
+        :param name: stage name
+        """
+        stack = self._stack()
+        stack.append(name)
+        path = ';'.join(stack)
+        wall, cpu = time.perf_counter(), self._cpu()
+        try:
+            yield
+        finally:
+            record = self._record(path)
+            with self.lock:
+                record['calls'] += 1
+                record['wall'] += time.perf_counter() - wall
+                record['cpu'] += self._cpu() - cpu
+                record['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            stack.pop()
+
+    @contextlib.contextmanager
+    def attach(self, path):
+        """
+        Nest the stages of this thread under `path`, see `path`
+
+        :param path: stage path, usually of another thread
+        """
+        stack = self._stack()
+        previous = stack[:]
+        stack[:] = path.split(';') if path else []
+        try:
+            yield
+        finally:
+            stack[:] = previous
+
+    def timed(self, iterator, name):
+        """
+        Measure the time spent waiting for each item of an iterator
+
+        :param iterator: iterator
+        :param name: stage name
+        :returns: iterator
+        """
+        iterator = iter(iterator)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, frames=0, nbytes=0):
+        """
+        Add frames and written bytes to the current stage
+
+        :param frames: number of output frames
+        :param nbytes: number of bytes written
+        """
+        record = self._record(self.path())
+        with self.lock:
+            record['frames'] += frames
+            record['bytes'] += nbytes
+            self.frames += frames
+        if self.progress and frames:
+            now = time.perf_counter()
+            if now - self.last_progress > 0.5:
+                self.last_progress = now
+                sys.stderr.write('\r%d frames, %.1f fps ' %
+                                 (self.frames, self.frames / (now - self.start)))
+                sys.stderr.flush()
+
+    def report(self):
+        """
+        Summary of the stages
+
+        :returns: dict
+        """
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        stages = []
+        for path, record in self.stages.items():
+            # Time not spent in sub-stages, for flamegraphs
+            inner = sum(other['wall'] for other_path, other in self.stages.items()
+                        if other_path.startswith(path + ';')
+                        and ';' not in other_path[len(path) + 1:])
+            stage = {'stage': path, 'self_wall': max(record['wall'] - inner, 0.)}
+            stage.update(record)
+            stages.append(stage)
+        return {'wall': time.perf_counter() - self.start,
+                'cpu': self._cpu(),
+                'frames': self.frames,
+                'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                'children_peak_rss_kb': children.ru_maxrss,
+                'stages': stages,
+                }
+
+    def write(self, path):
+        """
+        Write the report as JSON and as collapsed stacks (path.folded)
+
+        :param path: path to the JSON file
+        """
+        if self.progress:
+            sys.stderr.write('\n')
+        report = self.report()
+        with open(path, 'w') as jsonfile:
+            json.dump(report, jsonfile, indent=4)
+        with open(os.path.splitext(path)[0] + '.folded', 'w') as folded:
+            for stage in report['stages']:
+                # microseconds of wall time
+                folded.write('%s %d\n' % (stage['stage'], stage['self_wall'] * 1e6))
+
+
+def letterbox_geometry(size, resolution):
+    """
+    Size of an image fitted in a resolution, and its position
+
+    :param size: size of the image
+    :param resolution: output resolution
+    :returns: (new size, paste box)
+    """
+    if size[1] / size[0] > resolution[1] / resolution[0]:
+        # Match size along the vert. dir.
+        ratio = resolution[1]/size[1]
+        newsize = (math.floor(size[0]*ratio), resolution[1])
+        return newsize, (math.floor(math.fabs(resolution[0]-newsize[0])/2), 0)
+    ratio = resolution[0]/size[0]
+    newsize = (resolution[0], math.floor(size[1]*ratio))
+    return newsize, (0, math.floor(math.fabs(resolution[1]-newsize[1])/2))
+
+
+class Letterbox():
+    """
+    Resize and letterbox plan for one geometry
+
+    The new size and the paste box are computed once, and the background
+    border is filled once in a canvas reused for every frame.
+
+    :param size: size of the input images
+    :param resolution: output resolution
+    :param angle: rotation angle
+    :param color: background color
+    """
+    def __init__(self, size, resolution, angle=0, color=(0, 0, 0)):
+        self.size = tuple(size)
+        self.resolution = tuple(resolution)
+        self.angle = angle
+        # Rotation does not expand the image
+        self.identity = self.size == self.resolution
+        self.newsize, self.box = letterbox_geometry(size, resolution)
+        logger.debug('im Size: %s' % str(self.size))
+        logger.debug('bg Size: %s' % str(self.resolution))
+        logger.debug('New Size: %s' % str(self.newsize))
+        logger.debug('Box: %s' % str(self.box))
+        self.color = tuple(color)
+        self.canvas = Image.new("RGB", self.resolution, color=color)
+        # Boxes drawn over the border since the last frame, see Overlay
+        self.dirty = []
+
+    def apply(self, im, method=Image.NEAREST):
+        """
+        Resize and stick an image in the canvas
+
+        The canvas is returned and overwritten by the next call: `im` can
+        be recycled as soon as this returns.
+
+        :param im: image of the planned size
+        :param method: Method to resize images
+        :returns: image
+        """
+        if self.angle != 0:
+            im = im.rotate(self.angle)
+        for box in self.dirty:
+            self.canvas.paste(self.color, box)
+        self.dirty = []
+        if self.identity:
+            # Nothing to hide!
+            self.canvas.paste(im)
+            return self.canvas
+        # The border is only touched by overlays: one resize, one paste
+        self.canvas.paste(im.resize(self.newsize, method), box=self.box)
+        return self.canvas
+
+
+# (size, resolution, angle, color) -> Letterbox, per thread: canvases are not shared
+_plans = threading.local()
+
+# Plans kept per thread, each one holds a canvas of the output resolution
+PLAN_CACHE_SIZE = 4
+
+
+def letterbox_plan(size, resolution, angle=0, color=(0, 0, 0)):
+    """
+    Letterbox plan of a geometry, computed once
+
+    The last PLAN_CACHE_SIZE plans of the thread are kept.
+
+    :param size: size of the input images
+    :param resolution: output resolution
+    :param angle: rotation angle
+    :param color: background color
+    :returns: Letterbox instance
+    """
+    key = (tuple(size), tuple(resolution), angle, tuple(color))
+    if not hasattr(_plans, 'plans'):
+        # Least recently used first
+        _plans.plans = collections.OrderedDict()
+    if key in _plans.plans:
+        _plans.plans.move_to_end(key)
+    else:
+        _plans.plans[key] = Letterbox(size, resolution, angle=angle, color=color)
+        if len(_plans.plans) > PLAN_CACHE_SIZE:
+            _plans.plans.popitem(last=False)
+    return _plans.plans[key]
+
+
+class BufferPool():
+    """
+    Recycled images, to hold decoded pictures without allocating
+
+    A decoded picture is copied in a released image of the same mode and
+    size, and its own buffer is freed at once: only the recycled images
+    live while the picture is composited. Released images are kept by mode
+    and size; beyond `max_size` bytes of free images, the least recently
+    used ones are dropped.
+
+    :param max_size: bytes of free images kept, see MemoryBudget.buffer_size
+    """
+    def __init__(self, max_size=128 * 1024**2):
+        self.max_size = max_size
+        self.size = 0
+        # (mode, size) -> free images, least recently used first
+        self.free = collections.OrderedDict()
+        # id -> recycled image holding a decoded picture
+        self.used = {}
+
+    @staticmethod
+    def nbytes(mode, size):
+        """
+        Memory of a buffer
+
+        :param mode: image mode
+        :param size: image size
+        :returns: bytes
+        """
+        # Pixels of multiband images are stored on 4 bytes
+        return size[0] * size[1] * (4 if Image.getmodebands(mode) > 1 else 1)
+
+    def _trim(self):
+        while self.size > self.max_size:
+            key, buffers = next(iter(self.free.items()))
+            buffers.pop()
+            self.size -= self.nbytes(*key)
+            if not buffers:
+                del self.free[key]
+
+    def resize(self, max_size):
+        """
+        Change the bytes of free images kept
+
+        :param max_size: bytes
+        """
+        self.max_size = max_size
+        self._trim()
+
+    def load(self, im):
+        """
+        Decode an opened picture in a recycled image
+
+        Palette pictures are decoded in their own image: a copy would
+        lose the palette.
+
+        :param im: image returned by Image.open
+        :returns: decoded image, `im` or a recycled one
+        """
+        im.load()
+        if im.mode not in REDUCE_MODES:
+            return im
+        key = (im.mode, tuple(im.size))
+        buffers = self.free.get(key)
+        if buffers:
+            buffer = buffers.pop()
+            self.size -= self.nbytes(*key)
+            if not buffers:
+                del self.free[key]
+        else:
+            buffer = Image.new(*key)
+        buffer.paste(im)
+        buffer.info = im.info
+        # Frees the decoded buffer
+        im.close()
+        self.used[id(buffer)] = buffer
+        return buffer
+
+    def release(self, im):
+        """
+        Give back the recycled image returned by `load`
+
+        `im` must not be used anymore. Other images are ignored.
+
+        :param im: image
+        """
+        if self.used.pop(id(im), None) is None:
+            return
+        key = (im.mode, tuple(im.size))
+        self.free.setdefault(key, []).append(im)
+        self.free.move_to_end(key)
+        self.size += self.nbytes(*key)
+        self._trim()
+
+
+# Buffer pool of each thread
+_buffers = threading.local()
+
+
+# Part of a memory budget kept as free images, by all the processes
+BUFFER_SHARE = 0.25
+
+
+def buffer_pool():
+    """
+    Buffer pool of the current thread
+
+    :returns: BufferPool instance
+    """
+    if not hasattr(_buffers, 'pool'):
+        _buffers.pool = BufferPool()
+    return _buffers.pool
+
+
+class MemoryBudget():
+    """
+    Hard ceiling on the memory of the frames in flight
+
+    Producers acquire the memory of a frame before creating it and wait
+    while the ceiling is reached; a budget can be shared by several builds.
+
+    :param limit: bytes, None for no ceiling
+    """
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, nbytes, blocking=True):
+        """
+        Reserve memory
+
+        A single request larger than the ceiling is granted when nothing
+        else is reserved.
+
+        :param nbytes: bytes
+        :param blocking: wait for the memory, otherwise return False
+        :returns: boolean
+        """
+        with self.condition:
+            while (self.limit is not None and self.used
+                   and self.used + nbytes > self.limit):
+                if not blocking:
+                    return False
+                self.condition.wait()
+            self.used += nbytes
+            return True
+
+    def release(self, nbytes):
+        """
+        Give back reserved memory
+
+        :param nbytes: bytes
+        """
+        with self.condition:
+            self.used -= nbytes
+            self.condition.notify_all()
+
+    def buffer_size(self, workers=1):
+        """
+        Free images kept by the buffer pool of each compositing process
+
+        :param workers: number of processes sharing the budget
+        :returns: bytes, or None for the default of BufferPool
+        """
+        if self.limit is None:
+            return None
+        return int(self.limit * BUFFER_SHARE / workers)
 
 
 def add_bg(im, bg, angle=0, method=Image.NEAREST):
     """
-    Put image `im` on a background `bg`.
-    Pre-rotate the image with an `angle`.
+    Put image `im` on a background `bg`.
+    Pre-rotate the image with an `angle`.
+
+    :param im: foreground image
+    :param bg: background image
+    :param angle: rotation angle
+    :param method: Method to resize images
+    """
+    plan = letterbox_plan(im.size, bg.size, angle)
+    # Rotate the image
+    if angle != 0:
+        im = im.rotate(angle)
+
+    if plan.identity:
+        # Nothing to hide!
+        return im.copy()
+
+    # Copy to do not overwrite bg
+    wbg = bg.copy()
+    wbg.paste(im.resize(plan.newsize, method), box=plan.box)
+    return wbg
+
+
+# Modes supported by Image.reduce
+REDUCE_MODES = ('L', 'LA', 'RGB', 'RGBA', 'RGBX', 'CMYK', 'YCbCr')
+
+
+def open_picture(item, resolution, decode='full', pool=None):
+    """
+    Open a picture, decoded at a reduced size if it is much larger than needed
+
+    JPEG files are decoded at a reduced scale by the DCT (draft), other
+    formats are reduced by an integer factor. The final resize is done by
+    the caller.
+
+    :param item: path to the picture
+    :param resolution: output resolution
+    :param decode: 'full' (no reduction), 'quality' (keep at least twice the
+                   final size for the final resize) or 'fast' (keep the final size)
+    :param pool: BufferPool instance: the picture is decoded in a recycled
+                 buffer, to give back with its `release`
+    :returns: image
+    """
+    im = Image.open(item)
+    scale = 1
+    if decode != 'full':
+        factor = {'quality': 2, 'fast': 1}[decode]
+        newsize = letterbox_geometry(im.size, resolution)[0]
+        wanted = (newsize[0] * factor, newsize[1] * factor)
+        if im.format == 'JPEG':
+            # Picks the smallest scale larger than `wanted`
+            im.draft(im.mode, wanted)
+        else:
+            scale = min(im.size[0] // wanted[0], im.size[1] // wanted[1])
+    if pool is not None:
+        im = pool.load(im)
+    if scale >= 2:
+        if im.mode not in REDUCE_MODES:
+            # Palette, bilevel and 32 bit pictures can not be reduced
+            converted = im.convert('RGBA' if 'transparency' in im.info else 'RGB')
+            if pool is not None:
+                pool.release(im)
+            im = converted
+        reduced = im.reduce(scale)
+        if pool is not None:
+            pool.release(im)
+        im = reduced
+    return im
+
+
+def composite(item, resolution, angle=0, method=Image.NEAREST, decode='full',
+              profiler=None, overlay=None):
+    """
+    Open a picture and stick it on a black background.
+
+    The returned image may be a canvas reused by the next call.
+
+    :param item: path to the picture
+    :param resolution: background resolution
+    :param angle: rotation angle
+    :param method: Method to resize images
+    :param decode: decoding mode, see open_picture
+    :param profiler: Profiler instance or None
+    :param overlay: overlay drawn on the frame, see draw_overlay
+    :returns: image
+    """
+    profiler = profiler or Profiler()
+    pool = buffer_pool()
+    with profiler.stage('decode'):
+        im = open_picture(item, resolution, decode, pool)
+    try:
+        with profiler.stage('composite'):
+            plan = letterbox_plan(im.size, resolution, angle)
+            frame = plan.apply(im, method)
+            if overlay is not None:
+                plan.dirty.append(draw_overlay(frame, overlay))
+            return frame
+    finally:
+        # The frame is in the canvas
+        pool.release(im)
+
+
+def render(item, next_item, weight, resolution, angle=0, method=Image.NEAREST,
+           decode='full', profiler=None, overlay=None):
+    """
+    Composite a picture, optionally cross-faded with the next one
+
+    :param item: path to the picture
+    :param next_item: path to the next picture, used if `weight` is not 0
+    :param weight: weight of the next picture, between 0 and 1
+    :param resolution: background resolution
+    :param angle: rotation angle
+    :param method: Method to resize images
+    :param decode: decoding mode, see open_picture
+    :param profiler: Profiler instance or None
+    :param overlay: overlay drawn on the frame, see draw_overlay
+    :returns: image, see composite
+    """
+    if not weight:
+        return composite(item, resolution, angle, method, decode, profiler, overlay)
+    frame = composite(item, resolution, angle, method, decode, profiler)
+    # Both frames may share the same canvas: keep the first one aside
+    if getattr(_buffers, 'fade', None) is None or _buffers.fade.size != tuple(resolution):
+        _buffers.fade = Image.new('RGB', resolution)
+    fade = _buffers.fade
+    fade.paste(frame)
+    next_frame = composite(next_item, resolution, angle, method, decode, profiler)
+    frame = Image.blend(fade, next_frame, weight)
+    if overlay is not None:
+        draw_overlay(frame, overlay)
+    return frame
+
+
+class Overlay():
+    """
+    Text drawn in a corner of the frames: caption, speed, timestamp...
+
+    Glyphs are rendered once in an atlas; a label is assembled from the
+    atlas once per text, and only its rectangle is composited in a frame.
+
+    :param resolution: frame resolution
+    :param corner: 'top-left', 'top-right', 'bottom-left' or 'bottom-right'
+    :param size: font size in pixels, 1/30 of the frame height by default
+    :param color: text color
+    :param shade: opacity of the dark box behind the text, from 0 to 255
+    """
+    def __init__(self, resolution, corner='bottom-left', size=None, color=(255, 255, 255),
+                 shade=128):
+        if corner not in ('top-left', 'top-right', 'bottom-left', 'bottom-right'):
+            raise ValueError('Wrong overlay corner')
+        self.resolution = tuple(resolution)
+        self.corner = corner
+        self.size = size or max(resolution[1] // 30, 10)
+        self.color = tuple(color)
+        self.shade = shade
+        try:
+            self.font = ImageFont.load_default(self.size)
+        except TypeError:
+            # Pillow < 10.1: bitmap font of a single size
+            self.font = ImageFont.load_default()
+        left, top, right, bottom = self.font.getbbox('Ag|')
+        self.line_height = bottom + max(self.size // 5, 1)
+        self.padding = max(self.size // 3, 2)
+        # char -> glyph mask
+        self.atlas = {}
+        # text -> (label mask, shade mask), least recently used first
+        self.labels = collections.OrderedDict()
+
+    def glyph(self, char):
+        """
+        Mask of a character, rendered once
+
+        :param char: character
+        :returns: L image
+        """
+        if char not in self.atlas:
+            width = max(math.ceil(self.font.getlength(char)), 1)
+            mask = Image.new('L', (width, self.line_height))
+            ImageDraw.Draw(mask).text((0, 0), char, fill=255, font=self.font)
+            self.atlas[char] = mask
+        return self.atlas[char]
+
+    def label(self, text):
+        """
+        Masks of a text and of its box, assembled from the atlas
+
+        :param text: text, one line per newline
+        :returns: (label mask, shade mask)
+        """
+        if text in self.labels:
+            self.labels.move_to_end(text)
+            return self.labels[text]
+        lines = [[self.glyph(char) for char in line] for line in text.split('\n')]
+        width = max(sum(glyph.size[0] for glyph in line) for line in lines)
+        size = (width + 2 * self.padding, len(lines) * self.line_height + 2 * self.padding)
+        mask = Image.new('L', size)
+        y = self.padding
+        for line in lines:
+            x = self.padding
+            for glyph in line:
+                mask.paste(glyph, (x, y))
+                x += glyph.size[0]
+            y += self.line_height
+        self.labels[text] = (mask, Image.new('L', size, self.shade))
+        if len(self.labels) > 64:
+            self.labels.popitem(last=False)
+        return self.labels[text]
+
+    def apply(self, frame, text):
+        """
+        Draw a text in a frame, in place
+
+        :param frame: RGB image
+        :param text: text, one line per newline
+        :returns: box drawn over
+        """
+        mask, shade = self.label(text)
+        margin = self.padding
+        x = margin if self.corner.endswith('left') else self.resolution[0] - mask.size[0] - margin
+        y = margin if self.corner.startswith('top') else self.resolution[1] - mask.size[1] - margin
+        box = (x, y, x + mask.size[0], y + mask.size[1])
+        frame.paste((0, 0, 0), box, shade)
+        frame.paste(self.color, box, mask)
+        return box
+
+
+# Overlays of each thread: atlases are not sent to processes
+_overlays = threading.local()
+
+
+def draw_overlay(frame, overlay):
+    """
+    Draw an overlay in a frame, in place
+
+    :param frame: RGB image
+    :param overlay: dict with the text and the settings of Overlay
+                    (corner, size, color, shade)
+    :returns: box drawn over
+    """
+    settings = dict(overlay)
+    text = settings.pop('text')
+    key = (frame.size, tuple(sorted(settings.items())))
+    if not hasattr(_overlays, 'plans'):
+        _overlays.plans = {}
+    if key not in _overlays.plans:
+        _overlays.plans[key] = Overlay(frame.size, **settings)
+    return _overlays.plans[key].apply(frame, text)
+
+
+def picture_time(item):
+    """
+    Capture time of a picture, from EXIF or from the file modification time
+
+    :param item: path to the picture
+    :returns: datetime
+    """
+    try:
+        with Image.open(item) as im:
+            exif = im.getexif()
+        # DateTimeOriginal in the Exif IFD, else DateTime
+        stamp = exif.get_ifd(0x8769).get(0x9003) or exif.get(0x0132)
+        if stamp:
+            return datetime.datetime.strptime(stamp.strip('\x00 '), '%Y:%m:%d %H:%M:%S')
+    except (OSError, ValueError):
+        pass
+    return datetime.datetime.fromtimestamp(os.path.getmtime(item))
+
+
+def overlay_text(settings, item, speed=1):
+    """
+    Text of the overlay of a frame
+
+    :param settings: overlay section of the configuration: 'caption' (text),
+                     'speed' (boolean), 'timestamp' (strftime format or True)
+    :param item: path to the picture of the frame
+    :param speed: speed of the section
+    :returns: text
+    """
+    lines = []
+    if settings.get('caption'):
+        lines.append(settings['caption'])
+    if settings.get('speed'):
+        lines.append('x%g' % speed)
+    if settings.get('timestamp'):
+        fmt = settings['timestamp']
+        if fmt is True:
+            fmt = '%Y-%m-%d %H:%M:%S'
+        lines.append(picture_time(item).strftime(fmt))
+    return '\n'.join(lines)
+
+
+def resample(nb_sources, number, crossfade=False, start=0, stop=None):
+    """
+    Map output frames to source pictures
+
+    The output frame `k` shows the source at position k / number. The
+    position is computed with integers, so fractional ratios do not drift.
+    Consecutive identical frames are merged in runs.
+
+    :param nb_sources: number of source pictures
+    :param number: output frames per source picture
+    :param crossfade: blend the two sources around each position
+    :param start: first output frame
+    :param stop: last output frame (excluded), the end of the section by default
+    :returns: iterator of (source index, weight of the next source, times)
+    """
+    ratio = fractions.Fraction(number).limit_denominator(10**6)
+    if stop is None:
+        stop = resample_length(nb_sources, number)
+    run = None
+    times = 0
+    for k in range(start, stop):
+        idx, remainder = divmod(k * ratio.denominator, ratio.numerator)
+        weight = 0
+        if crossfade and remainder and idx + 1 < nb_sources:
+            weight = remainder / ratio.numerator
+        if (idx, weight) == run and not weight:
+            times += 1
+            continue
+        if run is not None:
+            yield run + (times,)
+        run = (idx, weight)
+        times = 1
+    if run is not None:
+        yield run + (times,)
+
+
+def resample_length(nb_sources, number):
+    """
+    Number of output frames of a section
+
+    :param nb_sources: number of source pictures
+    :param number: output frames per source picture
+    :returns: number of frames
+    """
+    ratio = fractions.Fraction(number).limit_denominator(10**6)
+    return round(nb_sources * ratio)
+
+
+def init_logging(level=logging.INFO):
+    """
+    Log to stderr, in the command line and in the worker processes
+
+    :param level: logging level
+    """
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+
+    steam_handler = logging.StreamHandler()
+    steam_handler.setLevel(level)
+    root_logger.addHandler(steam_handler)
+
+
+def init_worker(level=None, buffer_size=None):
+    """
+    Set up a compositing process
+
+    :param level: logging level, None to not log
+    :param buffer_size: bytes of free images of its buffer pool, None for
+                        the default
+    """
+    if level is not None:
+        init_logging(level)
+    if buffer_size is not None:
+        buffer_pool().resize(buffer_size)
+
+
+def process_pool(workers, budget=None):
+    """
+    Process pool whose workers do not inherit the pipes of the encoders
+
+    Forked workers would keep a copy of the stdin of a running encoder,
+    which then never sees the end of its input. Workers are started by a
+    fork server, or spawned where there is none, and log like this process.
+
+    :param workers: number of processes
+    :param budget: MemoryBudget instance sizing the buffer pools of the
+                   workers, or None
+    :returns: ProcessPoolExecutor instance
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+    else:
+        context = multiprocessing.get_context('spawn')
+    root_logger = logging.getLogger()
+    level = root_logger.level if root_logger.handlers else None
+    buffer_size = budget.buffer_size(workers) if budget is not None else None
+    return concurrent.futures.ProcessPoolExecutor(workers, mp_context=context,
+                                                  initializer=init_worker,
+                                                  initargs=(level, buffer_size))
+
+
+def ordered_map(func, iterable, executor=None, window=1, budget=None, cost=0):
+    """
+    Map `func` on `iterable` in a pool, keeping the order
+
+    At most `window` results are in flight, which bounds the memory. With a
+    budget, each call also reserves `cost` bytes until its result is
+    returned: when the ceiling is reached, no call is submitted before a
+    result is consumed here or in another build sharing the budget.
+
+    :param func: function
+    :param iterable: arguments, one tuple per call
+    :param executor: pool executor, None to run in the current process
+    :param window: number of calls submitted in advance
+    :param budget: MemoryBudget instance or None
+    :param cost: bytes of a result
+    :returns: iterator
+    """
+    if executor is None:
+        for args in iterable:
+            yield func(*args)
+        return
+    budget = budget or MemoryBudget()
+    pending = collections.deque()
+
+    def pop():
+        result = pending.popleft().result()
+        budget.release(cost)
+        return result
+    try:
+        for args in iterable:
+            # Our own results are consumed before waiting for other builds
+            while not budget.acquire(cost, blocking=not pending):
+                yield pop()
+            pending.append(executor.submit(func, *args))
+            if len(pending) >= window:
+                yield pop()
+        while pending:
+            yield pop()
+    finally:
+        budget.release(cost * len(pending))
+
+
+def picture_key(item, resolution, angle=0, method=Image.NEAREST, color=(0, 0, 0),
+                decode='full', overlay=None):
+    """
+    Cache key of a picture stuck on a background
+
+    The source file is identified by its path, mtime and size.
+
+    :param item: path to the picture
+    :param resolution: background resolution
+    :param angle: rotation angle
+    :param method: Method to resize images
+    :param color: background color
+    :param decode: decoding mode, see open_picture
+    :param overlay: overlay drawn on the frame, see draw_overlay
+    :returns: key
+    """
+    stat = os.stat(item)
+    parts = ('picture', os.path.realpath(item), stat.st_mtime_ns, stat.st_size,
+             tuple(resolution), angle, method, tuple(color), decode)
+    if overlay is not None:
+        parts += (tuple(sorted(overlay.items())),)
+    return FrameCache.key(*parts)
+
+
+class FrameCache():
+    """
+    Persistent cache of png frames, shared between runs
+
+    Least recently used frames are evicted when the size exceeds `max_size`,
+    down to `low_water` times `max_size`: the cache is not scanned again
+    for each new frame.
+
+    :param path: cache directory
+    :param max_size: maximum size in bytes
+    :param low_water: fraction of `max_size` left after an eviction
+    """
+    def __init__(self, path, max_size=10 * 1024**3, low_water=0.9):
+        self.path = path
+        self.max_size = max_size
+        self.low_water = low_water
+        self.lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        self.size = sum(size for mtime, size, filepath in self._entries())
+
+    def __getstate__(self):
+        # The lock is not shared with other processes
+        state = dict(self.__dict__)
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts):
+        """
+        Hash `parts` into a cache key
+
+        :param parts: anything with a stable repr
+        :returns: key
+        """
+        return hashlib.sha1(repr(parts).encode('utf8')).hexdigest()
+
+    def namespace(self, name, max_size=None):
+        """
+        Separate cache next to this one, with its own eviction
+
+        :param name: name of the namespace
+        :param max_size: maximum size in bytes, the one of this cache by default
+        :returns: FrameCache instance
+        """
+        return FrameCache(self.path + '-' + name, max_size or self.max_size,
+                          self.low_water)
+
+    def _path(self, key):
+        return os.path.join(self.path, key[:2], key + '.png')
+
+    def _entries(self):
+        for subdir in os.scandir(self.path):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if not entry.name.endswith('.png'):
+                    # Being written
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # Evicted by another process sharing the cache
+                    continue
+                yield (stat.st_mtime, stat.st_size, entry.path)
+
+    def get(self, key):
+        """
+        Look for a frame in the cache
+
+        :param key: cache key
+        :returns: path to the frame or None
+        """
+        path = self._path(key)
+        try:
+            # mtime is the LRU stamp
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, im, options=None):
+        """
+        Store a frame in the cache
+
+        :param key: cache key
+        :param im: frame
+        :param options: options of the png encoder, see FRAME_FORMATS
+        :returns: path to the frame
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as tmp:
+            im.save(tmp, format='PNG', **(options or {}))
+        return self._commit(tmp_file, path)
+
+    def put_file(self, key, filepath):
+        """
+        Store a png file in the cache
+
+        :param key: cache key
+        :param filepath: path to the png file
+        :returns: path to the frame
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as tmp, open(filepath, 'rb') as source:
+            shutil.copyfileobj(source, tmp)
+        return self._commit(tmp_file, path)
+
+    def _commit(self, tmp_file, path):
+        # Another process may evict the frame as soon as it is in the cache
+        size = os.path.getsize(tmp_file)
+        os.replace(tmp_file, path)
+        with self.lock:
+            self.size += size
+            if self.size > self.max_size:
+                self.evict()
+        return path
+
+    def evict(self):
+        """
+        Remove the least recently used frames until the cache is under its
+        low water mark
+        """
+        entries = sorted(self._entries())
+        self.size = sum(entry[1] for entry in entries)
+        for mtime, size, filepath in entries:
+            if self.size <= self.max_size * self.low_water:
+                break
+            logger.debug('Evict %s from the cache' % filepath)
+            try:
+                os.remove(filepath)
+            except FileNotFoundError:
+                # Evicted by another process sharing the cache
+                pass
+            self.size -= size
+
+
+def name_it(tmp_path, digits=6, start=0, ext='png'):
+    """
+    Iterator returning a picture name located in tmp_path
+
+    :param tmp_path:
+    :param digits: number of digits used in the name
+    :param start: first number
+    :param ext: file extension
+    :returns: iterator
+    """
+    i = start
+    while True:
+        pngfile = os.path.join(tmp_path, str(i).zfill(digits) + '.' + ext)
+        yield(pngfile)
+        i += 1
+
+
+
+##############Natural sorting
+
+_digits = re.compile('([0-9]+)')
+
+
+def alphanum_key(s):
+    """ Turn a string into a list of string and number chunks.
+        "z23a" -> ["z", 23, "a"]
+    """
+    # Odd chunks are the runs of digits captured by the split
+    return [int(c) if i % 2 else c for i, c in enumerate(_digits.split(s))]
+
+##############Natural sorting : end
+
+
+PICTURE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp', '.gif',
+                      '.ppm', '.pgm', '.webp')
+
+# First bytes of the supported formats
+PICTURE_MAGICS = (b'\xff\xd8\xff',          # jpeg
+                  b'\x89PNG\r\n\x1a\n',     # png
+                  b'II*\x00', b'MM\x00*',     # tiff
+                  b'BM',                     # bmp
+                  b'GIF87a', b'GIF89a',      # gif
+                  b'P5', b'P6',              # pgm, ppm
+                  b'RIFF',                   # webp
+                  )
+
+
+def is_picture(path):
+    """
+    Check the extension and the first bytes of a file
+
+    :param path: file path
+    :returns: boolean
+    """
+    if not path.lower().endswith(PICTURE_EXTENSIONS):
+        return False
+    with open(path, 'rb') as fh:
+        head = fh.read(8)
+    return head.startswith(PICTURE_MAGICS)
+
+
+# directory -> (mtime, sorted pictures)
+_listings = {}
+_listings_lock = threading.Lock()
+
+
+def scan_pictures(path):
+    """
+    Sorted (natural order) list of the pictures of a directory
+
+    Other files are ignored with a warning. The listing is cached until
+    the mtime of the directory changes.
+
+    :param path: directory
+    :returns: tuple of paths
+    """
+    path = os.path.abspath(path)
+    mtime = os.stat(path).st_mtime_ns
+    with _listings_lock:
+        if path in _listings and _listings[path][0] == mtime:
+            return _listings[path][1]
+
+    names = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            if not is_picture(entry.path):
+                logger.warning('Ignore %s: not a picture' % entry.path)
+                continue
+            names.append(entry.name)
+    pictures = tuple(os.path.join(path, name) for name in sorted(names, key=alphanum_key))
+    with _listings_lock:
+        _listings[path] = (mtime, pictures)
+    return pictures
+
+
+def file_fingerprint(path):
+    """
+    Identify a file by its path, mtime and size
+
+    :param path: file path
+    :returns: list
+    """
+    stat = os.stat(path)
+    return [path, stat.st_mtime_ns, stat.st_size]
+
+
+def tex_dependencies(tex_path):
+    """
+    Files included by a tex file (input, include, includegraphics)
+
+    :param tex_path: path to the tex file
+    :returns: list of paths
+    """
+    regex = re.compile(r'\\(?:input|include|includegraphics)(?:\[[^\]]*\])?\{([^}]+)\}')
+    root = os.path.dirname(tex_path)
+    deps = []
+    with open(tex_path, 'r') as texfile:
+        content = texfile.read()
+    for match in regex.finditer(content):
+        name = os.path.join(root, match.group(1).strip())
+        for ext in ('', '.tex', '.pdf', '.png', '.jpg', '.jpeg', '.eps'):
+            if os.path.isfile(name + ext):
+                deps.append(name + ext)
+                break
+    return deps
+
+
+def file_digest(path):
+    """
+    Hash the content of a file
+
+    :param path: file path
+    :returns: hex digest
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1024**2), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def slide_key(tex_path, resolution):
+    """
+    Cache key of a slide
+
+    The tex file and the files it includes are identified by their content.
+
+    :param tex_path: path to the tex file
+    :param resolution: picture resolution of the slides
+    :returns: key
+    """
+    deps = [file_digest(dep) for dep in [tex_path] + tex_dependencies(tex_path)]
+    return FrameCache.key('slide', deps, tuple(resolution))
+
+
+def pdf_density(pdffile, resolution):
+    """
+    Density to rasterize a pdf file directly at a resolution
+
+    :param pdffile: path to the pdf file
+    :param resolution: picture resolution
+    :returns: density in dpi
+    """
+    # At the default density (72 dpi), one pixel is one point
+    command = ['/usr/bin/identify', '-format', '%w %h', str(pdffile) + '[0]']
+    logger.debug('Command: %s' % command)
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    try:
+        width, height = (float(item) for item in stdout.split())
+    except ValueError:
+        logger.warning('Can not read the size of %s' % pdffile)
+        return 600
+    return math.ceil(72 * max(resolution[0] / width, resolution[1] / height))
+
+
+def make_slide(tex_path, tmp_path, resolution=(1200, 800), cache=None, profiler=None):
+    """
+    Make introduction png files
+
+    :param tex_path: path to the tex file
+    :param tmp_path: path to a tmp dir
+    :param resolution: picture resolution of the slides
+    :param cache: FrameCache instance or None
+    :param profiler: Profiler instance or None
+    :returns: png file path
+    """
+    profiler = profiler or Profiler()
+    if cache is not None:
+        key = slide_key(tex_path, resolution)
+        cached_file = cache.get(key)
+        if cached_file is not None:
+            logger.debug('Slide %s found in the cache' % tex_path)
+            return cached_file
+
+    logger.debug('Build a tex file')
+    resol = str(resolution[0]) + 'x' + str(resolution[1])
+
+    filename = os.path.splitext(os.path.basename(tex_path))[0]
+    #dvifile = os.path.join(tmp_path, filename + '.dvi')
+    pdffile = os.path.join(tmp_path, filename + '.pdf')
+    pngfile = os.path.join(tmp_path, filename + '.png')
+
+    #command = ['/usr/bin/latex', '-output-directory=' + str(tmp_path), str(texfile)]
+    command = ['/usr/bin/pdflatex', '-output-directory=' + str(tmp_path), str(tex_path)]
+    logger.debug('Command: %s' % command)
+    with profiler.stage('pdflatex'):
+        run_command(command)
+
+    with profiler.stage('convert'):
+        # Rasterize at the final resolution, not at a higher one then downscale
+        density = pdf_density(pdffile, resolution)
+        command = ['/usr/bin/convert', '-density', str(density), str(pdffile),
+                   '-resize', resol,  str(pngfile)]
+        logger.debug('Command: %s' % command)
+        #command = ['/usr/bin/dvipng', '-o', str(pngfile), str(dvifile)]
+        run_command(command)
+    if cache is not None and os.path.isfile(pngfile):
+        return cache.put_file(key, pngfile)
+    return pngfile
+
+
+def make_slides(paths, tmp_dir, resolution=(1200, 800), cache=None, jobs=1,
+                profiler=None, executor=None, wait=True):
+    """
+    Make the png files of several slides at once
+
+    :param paths: paths to the tex files
+    :param tmp_dir: directory where the slides are compiled
+    :param resolution: picture resolution of the slides
+    :param cache: FrameCache instance or None
+    :param jobs: number of slides compiled at the same time
+    :param profiler: Profiler instance or None
+    :param executor: thread pool executor, a new one of `jobs` threads if None
+    :param wait: if False, return futures and compile in the background;
+                 `executor` is required
+    :returns: dict tex path -> png file path (or its future)
+    """
+    profiler = profiler or Profiler()
+    paths = list(collections.OrderedDict.fromkeys(paths))
+    tmp_paths = [tempfile.mkdtemp(dir=tmp_dir, prefix='tmpSlide') for path in paths]
+    parent = profiler.path()
+
+    def task(path, tmp_path):
+        with profiler.attach(parent), profiler.stage('slides'):
+            return make_slide(path, tmp_path, resolution, cache=cache,
+                              profiler=profiler)
+    if not wait:
+        return {path: executor.submit(task, path, tmp_path)
+                for path, tmp_path in zip(paths, tmp_paths)}
+    if executor is not None:
+        return dict(zip(paths, executor.map(task, paths, tmp_paths)))
+    # pdflatex and convert do the work: threads are enough
+    with concurrent.futures.ThreadPoolExecutor(max(jobs, 1)) as executor:
+        pngfiles = executor.map(task, paths, tmp_paths)
+        return dict(zip(paths, pngfiles))
+
+
+# Movies built by default: xvid avi at the full resolution and a small ogv
+RENDITIONS = [{'codec': 'mpeg4', 'tag': 'xvid', 'bitrate': '2048k',
+               'container': 'avi'},
+              {'codec': 'libtheora', 'size': '448x336', 'bitrate': '900k',
+               'container': 'ogg', 'extension': 'ogv'},
+              ]
+
+
+# Encoder profiles, selected by the 'profile' key of a rendition
+PROFILES = {'xvid': {'codec': 'mpeg4', 'tag': 'xvid', 'bitrate': '2048k',
+                     'container': 'avi'},
+            'theora': {'codec': 'libtheora', 'bitrate': '900k',
+                       'container': 'ogg', 'extension': 'ogv'},
+            'x264': {'codec': 'libx264', 'preset': 'medium', 'container': 'mp4',
+                     'options': ['-crf', '20', '-pix_fmt', 'yuv420p']},
+            'x265': {'codec': 'libx265', 'preset': 'medium', 'container': 'mp4',
+                     'tag': 'hvc1', 'options': ['-crf', '24', '-pix_fmt', 'yuv420p']},
+            'vp9': {'codec': 'libvpx-vp9', 'container': 'webm',
+                    'options': ['-b:v', '0', '-crf', '32', '-row-mt', '1',
+                                '-pix_fmt', 'yuv420p']},
+            'av1': {'codec': 'libsvtav1', 'preset': '8', 'container': 'matroska',
+                    'options': ['-crf', '35', '-pix_fmt', 'yuv420p']},
+            }
+
+
+def resolve_rendition(rendition):
+    """
+    Complete a rendition with the values of its profile
+
+    :param rendition: dict describing the rendition
+    :returns: dict
+    """
+    if 'profile' not in rendition:
+        return rendition
+    if rendition['profile'] not in PROFILES:
+        raise ValueError('Unknown encoder profile: %s' % rendition['profile'])
+    resolved = dict(PROFILES[rendition['profile']])
+    resolved.update(rendition)
+    return resolved
+
+
+def rendition_extension(rendition):
+    """
+    File extension of a rendition
+
+    :param rendition: dict describing the rendition
+    :returns: extension
+    """
+    rendition = resolve_rendition(rendition)
+    container = rendition.get('container', 'avi')
+    default = {'ogg': 'ogv', 'matroska': 'mkv'}.get(container, container)
+    return rendition.get('extension', default)
+
+
+def stream_lines(pipe):
+    """
+    Read the output of an external tool line by line, as it comes
+
+    Progress lines of ffmpeg end with a carriage return: they are split too.
+
+    :param pipe: binary pipe
+    :returns: iterator of strings
+    """
+    pending = b''
+    for block in iter(functools.partial(pipe.read1, 65536), b''):
+        *lines, pending = re.split(rb'[\r\n]', pending + block)
+        for line in lines:
+            if line:
+                yield line.decode('utf8', 'replace')
+    if pending:
+        yield pending.decode('utf8', 'replace')
+
+
+def log_output(pipe, tail=20, lines=None):
+    """
+    Log the output of an external tool without keeping it in memory
+
+    :param pipe: binary pipe
+    :param tail: number of last lines returned
+    :param lines: deque filled with the last lines as they come, a new one
+                  by default
+    :returns: deque of the last lines
+    """
+    if lines is None:
+        lines = collections.deque(maxlen=tail)
+    for line in stream_lines(pipe):
+        logger.debug(line)
+        lines.append(line)
+    return lines
+
+
+def run_command(command, feed=None):
+    """
+    Run an external tool and log its output
+
+    The output is logged line by line; only its end is reported if the
+    tool fails.
+
+    :param command: list of arguments
+    :param feed: function writing the input of the tool in the pipe given
+                 as argument, or None
+    :returns: exit code, 0
+    :raises subprocess.CalledProcessError: if the tool fails
+    """
+    logger.debug('command: ' + str(command))
+    process = subprocess.Popen(command,
+                               stdin=subprocess.DEVNULL if feed is None else subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if feed is None:
+        with process.stdout:
+            lines = log_output(process.stdout)
+    else:
+        # The output is read meanwhile: a full pipe would block the tool
+        with concurrent.futures.ThreadPoolExecutor(1) as reader, process.stdout:
+            output = reader.submit(log_output, process.stdout)
+            try:
+                with process.stdin:
+                    feed(process.stdin)
+            except BrokenPipeError:
+                # The tool stopped reading: its exit code tells why
+                logger.debug('%s closed its input' % command[0])
+            lines = output.result()
+    returncode = process.wait()
+    if returncode:
+        logger.error('%s failed (%d):\n%s' % (command[0], returncode, '\n'.join(lines)))
+        raise subprocess.CalledProcessError(returncode, command, '\n'.join(lines))
+    return returncode
+
+
+def encode_command(input_args, dests, resolution, renditions, filters=None):
+    """
+    ffmpeg command building all the renditions from one decode
+
+    The decoded frames are split and scaled once per rendition.
+
+    :param input_args: ffmpeg arguments describing the input
+    :param dests: path of each rendition
+    :param resolution: movie resolution
+    :param renditions: list of dicts (profile, codec, size, bitrate, container,
+                       tag, preset, threads, options)
+    :param filters: filters applied before the split
+    :returns: list of arguments
+    """
+    renditions = [resolve_rendition(rendition) for rendition in renditions]
+    chain = list(filters or []) + ['split=%d' % len(renditions)]
+    graph = '[0:v]' + ','.join(chain)
+    graph += ''.join('[s%d]' % i for i in range(len(renditions)))
+    for i, rendition in enumerate(renditions):
+        size = rendition.get('size', '%dx%d' % tuple(resolution))
+        graph += ';[s%d]scale=%s[o%d]' % (i, size.replace('x', ':'), i)
+
+    command = ['ffmpeg', '-y'] + list(input_args) + ['-filter_complex', graph]
+    for i, (rendition, dest) in enumerate(zip(renditions, dests)):
+        command += ['-map', '[o%d]' % i, '-vcodec', rendition['codec']]
+        if 'tag' in rendition:
+            command += ['-vtag', rendition['tag']]
+        if 'bitrate' in rendition:
+            command += ['-b:v', rendition['bitrate']]
+        if 'preset' in rendition:
+            command += ['-preset', str(rendition['preset'])]
+        if 'threads' in rendition:
+            command += ['-threads', str(rendition['threads'])]
+        command += list(rendition.get('options', []))
+        command += ['-f', rendition.get('container', 'avi'), dest]
+    return command
+
+
+# Formats of the frames written on disk, all lossless: png compression is
+# slow, the other ones are larger. 'raw' frames are piped to the encoder.
+FRAME_FORMATS = {'png': {'extension': 'png', 'options': {}, 'bytes_per_pixel': 1.5},
+                 'png-fast': {'extension': 'png', 'options': {'compress_level': 1},
+                              'bytes_per_pixel': 2},
+                 'png-none': {'extension': 'png', 'options': {'compress_level': 0},
+                              'bytes_per_pixel': 3},
+                 'bmp': {'extension': 'bmp', 'options': {}, 'bytes_per_pixel': 3},
+                 'ppm': {'extension': 'ppm', 'options': {}, 'bytes_per_pixel': 3},
+                 'raw': {'extension': 'rgb', 'options': {}, 'bytes_per_pixel': 3},
+                 }
+
+
+def raw_input_args(resolution, fps=25):
+    """
+    Input arguments of ffmpeg for rgb24 frames read on stdin
+
+    :param resolution: frame resolution
+    :param fps: frame per second
+    :returns: list of arguments
+    """
+    resol = str(resolution[0]) + 'x' + str(resolution[1])
+    return ['-f', 'rawvideo',
+            '-pix_fmt', 'rgb24',
+            '-s', resol,
+            '-r', str(fps),
+            '-i', '-']
+
+
+def feed_frames(entries):
+    """
+    Function writing raw frame files in a pipe, see run_command
+
+    Files are memory mapped, not read in Python buffers.
+
+    :param entries: list of (path, times)
+    :returns: function
+    """
+    def feed(pipe):
+        for path, times in entries:
+            with open(path, 'rb') as frame, \
+                    mmap.mmap(frame.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for _ in range(times):
+                    pipe.write(data)
+    return feed
+
+
+class PictureDirSink():
+    """
+    Store frames as picture files in a directory
+
+    :param pic_dir: directory where frames are written
+    :param profiler: Profiler instance or None
+    :param frame_format: format of the frames, see FRAME_FORMATS
+    :param resolution: movie resolution, required by the 'raw' format
+    """
+    def __init__(self, pic_dir, profiler=None, frame_format='png', resolution=None):
+        if frame_format not in FRAME_FORMATS:
+            raise ValueError('Wrong frame format')
+        if frame_format == 'raw' and resolution is None:
+            raise ValueError('Raw frames need the resolution')
+        self.pic_dir = pic_dir
+        self.profiler = profiler or Profiler()
+        self.frame_format = frame_format
+        self.extension = FRAME_FORMATS[frame_format]['extension']
+        self.resolution = resolution
+        self.generator = name_it(self.pic_dir, ext=self.extension)
+        self.nb_frames = 0
+
+    def save(self, im, dest):
+        """
+        Write a frame in the format of the sink
+
+        :param im: frame
+        :param dest: path of the frame
+        """
+        if self.extension != 'png' and im.mode != 'RGB':
+            im = im.convert('RGB')
+        if self.frame_format != 'raw':
+            im.save(dest, **FRAME_FORMATS[self.frame_format]['options'])
+            return
+        if im.size != tuple(self.resolution):
+            im = letterbox_plan(im.size, self.resolution).apply(im)
+        with open(dest, 'wb') as frame:
+            frame.write(im.tobytes())
+
+    def link(self, path, dest):
+        """
+        Write a picture file as a frame, without a copy if possible
+
+        :param path: path to the picture
+        :param dest: path of the frame
+        :returns: bytes written
+        """
+        if os.path.splitext(path)[1] != '.' + self.extension or self.frame_format == 'raw':
+            self.save(Image.open(path), dest)
+            return os.path.getsize(dest)
+        try:
+            os.link(path, dest)
+            return 0
+        except OSError:
+            # Not on the same filesystem
+            shutil.copy(path, dest)
+            return os.path.getsize(dest)
+
+    def add(self, im, times=1):
+        """
+        Add a frame `times` times
+
+        :param im: frame
+        :param times: number of output frames
+        """
+        with self.profiler.stage('write'):
+            first = None
+            for _ in range(times):
+                dest = self.generator.__next__()
+                if first is None:
+                    self.save(im, dest)
+                    first = dest
+                else:
+                    # Duplicate and preserve disk space
+                    os.link(first, dest)
+            nbytes = os.path.getsize(first) if first else 0
+            self.nb_frames += times
+            self.profiler.count(frames=times, nbytes=nbytes)
+
+    def add_file(self, path, times=1):
+        """
+        Add a picture file `times` times
+
+        :param path: path to the picture
+        :param times: number of output frames
+        """
+        with self.profiler.stage('write'):
+            first = None
+            nbytes = 0
+            for _ in range(times):
+                dest = self.generator.__next__()
+                if first is None:
+                    nbytes = self.link(path, dest)
+                    first = dest
+                else:
+                    os.link(first, dest)
+            self.nb_frames += times
+            self.profiler.count(frames=times, nbytes=nbytes)
+
+    def position(self):
+        """
+        Position of the sink, to resume later with `seek`
+
+        :returns: [output frames, files]
+        """
+        return [self.nb_frames, self.nb_frames]
+
+    def _remove_from(self, index):
+        # Frames written after a checkpoint
+        for entry in os.scandir(self.pic_dir):
+            name = os.path.splitext(entry.name)[0]
+            if name.isdigit() and int(name) >= index:
+                os.remove(entry.path)
+
+    def seek(self, position):
+        """
+        Resume after frames written by a previous run
+
+        Frames after the position are removed.
+
+        :param position: see `position`
+        """
+        frames, files = position
+        self._remove_from(files)
+        self.generator = name_it(self.pic_dir, start=files, ext=self.extension)
+        self.nb_frames = frames
+
+    def verify(self, position):
+        """
+        Cheap check of the frames written by a previous run
+
+        :param position: see `position`
+        :returns: boolean
+        """
+        frames, files = position
+        if files == 0:
+            return True
+        last = next(name_it(self.pic_dir, start=files - 1, ext=self.extension))
+        return os.path.isfile(last) and os.path.getsize(last) > 0
+
+    def mark(self):
+        """
+        Position from which frames can be replayed, see `replay`
+
+        :returns: position
+        """
+        return self.position()
+
+    def replay(self, start, stop):
+        """
+        Add again the frames written between two positions
+
+        Frames are hard links to the existing ones.
+
+        :param start: position returned by `mark`
+        :param stop: later position
+        """
+        with self.profiler.stage('write'):
+            frames = itertools.islice(name_it(self.pic_dir, start=start[1],
+                                              ext=self.extension),
+                                      stop[1] - start[1])
+            for frame in frames:
+                os.link(frame, self.generator.__next__())
+            self.nb_frames += stop[0] - start[0]
+            self.profiler.count(frames=stop[0] - start[0])
+
+    def release(self):
+        """
+        The frames since `mark` are no longer replayed
+
+        They are files of the movie: nothing to drop.
+        """
+
+    def chunk_inputs(self, chunks=1, fps=25):
+        """
+        Split the frames in consecutive ranges encoded independently
+
+        :param chunks: number of ranges
+        :param fps: frame per second
+        :returns: list of (ffmpeg input arguments, filters, feed), see run_command
+        """
+        size = max(math.ceil(self.nb_frames / chunks), 1)
+        inputs = []
+        for start in range(0, max(self.nb_frames, 1), size):
+            count = min(size, self.nb_frames - start)
+            if self.frame_format == 'raw':
+                frames = itertools.islice(name_it(self.pic_dir, start=start,
+                                                  ext=self.extension), count)
+                inputs.append((raw_input_args(self.resolution, fps), [],
+                               feed_frames([(frame, 1) for frame in frames])))
+                continue
+            input_args = ['-framerate', str(fps), '-start_number', str(start),
+                          '-i', os.path.join(self.pic_dir, '%06d.' + self.extension)]
+            inputs.append((input_args, ['trim=end_frame=' + str(count)], None))
+        return inputs
+
+    def encode(self, dests, resolution, fps=25, renditions=RENDITIONS, chunks=1):
+        """
+        Encode the frames
+
+        With several chunks, frame ranges are encoded in parallel processes,
+        each one starting with a keyframe, then concatenated without
+        re-encoding.
+
+        :param dests: path of each rendition
+        :param resolution: movie resolution
+        :param fps: frame per second
+        :param renditions: list of renditions, see encode_command
+        :param chunks: number of chunks
+        """
+        inputs = self.chunk_inputs(chunks, fps)
+        if len(inputs) == 1:
+            input_args, filters, feed = inputs[0]
+            run_command(encode_command(input_args, dests, resolution, renditions,
+                                       filters=filters), feed)
+            return
+        chunk_dests = [[os.path.join(self.pic_dir, 'chunk%d.%d.%s' %
+                                     (c, i, rendition_extension(rendition)))
+                        for i, rendition in enumerate(renditions)]
+                       for c in range(len(inputs))]
+        commands = [encode_command(input_args, chunk_dest, resolution, renditions,
+                                   filters=filters)
+                    for (input_args, filters, feed), chunk_dest in zip(inputs, chunk_dests)]
+        feeds = [feed for input_args, filters, feed in inputs]
+        with concurrent.futures.ThreadPoolExecutor(len(commands)) as executor:
+            list(executor.map(run_command, commands, feeds))
+        for i, dest in enumerate(dests):
+            concat_segments([chunk_dest[i] for chunk_dest in chunk_dests], dest,
+                            self.pic_dir)
+
+
+class TimelineSink(PictureDirSink):
+    """
+    Store each distinct frame once as a picture file, with a display duration
+
+    The encoder reads the frames from an ffconcat list, so the number of
+    files does not depend on the number of output frames.
+
+    :param pic_dir: directory where frames are written
+    :param profiler: Profiler instance or None
+    :param persistent: keep the timeline in a file of pic_dir, to resume
+    :param frame_format: format of the frames, see FRAME_FORMATS
+    :param resolution: movie resolution, required by the 'raw' format
+    """
+    def __init__(self, pic_dir, profiler=None, persistent=False, frame_format='png',
+                 resolution=None):
+        super().__init__(pic_dir, profiler, frame_format, resolution)
+        self.timeline = []
+        self.listing = None
+        if persistent:
+            self.listing = os.path.join(self.pic_dir, 'timeline.jsonl')
+            open(self.listing, 'a').close()
+
+    def _append(self, dest, times):
+        self.timeline.append((dest, times))
+        if self.listing is not None:
+            with open(self.listing, 'a') as listing:
+                listing.write(json.dumps([os.path.basename(dest), times]) + '\n')
+
+    def position(self):
+        """
+        Position of the sink, to resume later with `seek`
+
+        :returns: [output frames, timeline entries]
+        """
+        return [self.nb_frames, len(self.timeline)]
+
+    def seek(self, position):
+        """
+        Resume after frames written by a previous run
+
+        Frames and timeline entries after the position are removed.
+
+        :param position: see `position`
+        """
+        frames, entries = position
+        self.timeline = []
+        if self.listing is not None:
+            with open(self.listing, 'r') as listing:
+                for line in itertools.islice(listing, entries):
+                    name, times = json.loads(line)
+                    self.timeline.append((os.path.join(self.pic_dir, name), times))
+            with open(self.listing, 'w') as listing:
+                for dest, times in self.timeline:
+                    listing.write(json.dumps([os.path.basename(dest), times]) + '\n')
+        if len(self.timeline) != entries:
+            raise ValueError('The timeline can not be resumed')
+        self._remove_from(entries)
+        self.generator = name_it(self.pic_dir, start=entries, ext=self.extension)
+        self.nb_frames = frames
+
+    def verify(self, position):
+        """
+        Cheap check of the frames and timeline written by a previous run
+
+        :param position: see `position`
+        :returns: boolean
+        """
+        if self.listing is None or not super().verify(position):
+            return False
+        with open(self.listing, 'r') as listing:
+            return sum(1 for line in listing) >= position[1]
+
+    def replay(self, start, stop):
+        """
+        Add again the frames written between two positions
+
+        The timeline entries are repeated, no file is written.
+
+        :param start: position returned by `mark`
+        :param stop: later position
+        """
+        for dest, times in self.timeline[start[1]:stop[1]]:
+            self._append(dest, times)
+        self.nb_frames += stop[0] - start[0]
+        self.profiler.count(frames=stop[0] - start[0])
+
+    def add(self, im, times=1):
+        """
+        Add a frame displayed during `times` frames
+
+        :param im: frame
+        :param times: number of output frames
+        """
+        if times < 1:
+            return
+        with self.profiler.stage('write'):
+            dest = self.generator.__next__()
+            self.save(im, dest)
+            self._append(dest, times)
+            self.nb_frames += times
+            self.profiler.count(frames=times, nbytes=os.path.getsize(dest))
+
+    def add_file(self, path, times=1):
+        """
+        Add a picture file displayed during `times` frames
+
+        :param path: path to the picture
+        :param times: number of output frames
+        """
+        if times < 1:
+            return
+        with self.profiler.stage('write'):
+            dest = self.generator.__next__()
+            nbytes = self.link(path, dest)
+            self._append(dest, times)
+            self.nb_frames += times
+            self.profiler.count(frames=times, nbytes=nbytes)
+
+    def write_list(self, listfile, fps=25, timeline=None):
+        """
+        Write the timeline as an ffconcat list
+
+        :param listfile: path to the list
+        :param fps: frame per second
+        :param timeline: part of the timeline, all of it by default
+        """
+        if timeline is None:
+            timeline = self.timeline
+        with open(listfile, 'w') as ffconcat:
+            ffconcat.write('ffconcat version 1.0\n')
+            for dest, times in timeline:
+                ffconcat.write("file '%s'\n" % os.path.basename(dest))
+                ffconcat.write('duration %s\n' % repr(times / fps))
+            if timeline:
+                # The duration of the last entry is ignored without this
+                ffconcat.write("file '%s'\n" % os.path.basename(timeline[-1][0]))
+
+    def chunk_inputs(self, chunks=1, fps=25):
+        """
+        Split the timeline in consecutive parts encoded independently
+
+        Parts are cut between entries, at about the same number of frames.
+
+        :param chunks: number of parts
+        :param fps: frame per second
+        :returns: list of (ffmpeg input arguments, filters, feed), see run_command
+        """
+        size = max(math.ceil(self.nb_frames / chunks), 1)
+        parts = [[]]
+        count = 0
+        for entry in self.timeline:
+            if count >= size:
+                parts.append([])
+                count = 0
+            parts[-1].append(entry)
+            count += entry[1]
+        inputs = []
+        for i, part in enumerate(parts):
+            if self.frame_format == 'raw':
+                # Durations are repetitions of the frame in the pipe
+                inputs.append((raw_input_args(self.resolution, fps), [],
+                               feed_frames(part)))
+                continue
+            listfile = os.path.join(self.pic_dir, 'timeline%d.ffconcat' % i)
+            self.write_list(listfile, fps, part)
+            input_args = ['-f', 'concat', '-safe', '0', '-i', listfile]
+            # Constant frame rate from the durations
+            filters = ['fps=' + str(fps),
+                       'trim=end_frame=' + str(sum(times for dest, times in part))]
+            inputs.append((input_args, filters, None))
+        return inputs
+
+
+class EncoderPipeSink():
+    """
+    Write frames as raw RGB bytes into the stdin of an encoder
+
+    The encoder is started on the first frame and lives until `close`.
+
+    :param resolution: frame resolution
+    :param outputs: path of each rendition
+    :param fps: frame per second
+    :param renditions: list of renditions, see encode_command
+    :param profiler: Profiler instance or None
+    :param spool_dir: directory of the frames kept to be replayed, see `mark`
+    """
+    def __init__(self, resolution, outputs, fps=25, renditions=RENDITIONS,
+                 profiler=None, spool_dir=None):
+        self.profiler = profiler or Profiler()
+        self.resolution = resolution
+        self.outputs = outputs
+        self.fps = fps
+        self.renditions = renditions
+        self.spool_dir = spool_dir
+        # Frames are not files
+        self.extension = None
+        self.nb_frames = 0
+        self.process = None
+        self.log = None
+        self.spool = None
+        # (offset, size, times) of each frame in the spool
+        self.spooled = []
+
+    def _start(self):
+        input_args = raw_input_args(self.resolution, self.fps)
+        command = encode_command(input_args, self.outputs, self.resolution,
+                                 self.renditions)
+        logger.debug('command: ' + str(command))
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                        stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.PIPE)
+        # stderr is read as it comes: a full pipe would block the encoder.
+        # A daemon thread: an encoder left running must not block the exit
+        self.lines = collections.deque(maxlen=20)
+        self.log = threading.Thread(target=log_output, daemon=True,
+                                    args=(self.process.stderr,),
+                                    kwargs={'lines': self.lines})
+        self.log.start()
+
+    def _write(self, data):
+        try:
+            self.process.stdin.write(data)
+        except BrokenPipeError:
+            # The encoder exited: report its error, not the pipe one
+            self._wait()
+            raise
+
+    def _wait(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        with self.profiler.stage('encode'):
+            returncode = self.process.wait()
+        self.log.join()
+        lines = self.lines
+        self.process.stderr.close()
+        command = self.process.args
+        self.process = None
+        if returncode:
+            logger.error('ffmpeg failed (%d):\n%s' % (returncode, '\n'.join(lines)))
+            raise subprocess.CalledProcessError(returncode, command, '\n'.join(lines))
+
+    def add(self, im, times=1):
+        """
+        Add a frame `times` times
+
+        :param im: frame
+        :param times: number of output frames
+        """
+        if self.process is None:
+            self._start()
+        with self.profiler.stage('write'):
+            if im.mode != 'RGB':
+                im = im.convert('RGB')
+            data = im.tobytes()
+            for _ in range(times):
+                self._write(data)
+            if self.spool is not None:
+                self.spooled.append((self.spool.tell(), len(data), times))
+                self.spool.write(data)
+            self.nb_frames += times
+            self.profiler.count(frames=times, nbytes=len(data) * times)
+
+    def position(self):
+        """
+        Position of the sink
+
+        :returns: [output frames, spooled frames]
+        """
+        return [self.nb_frames, len(self.spooled)]
+
+    def mark(self):
+        """
+        Keep the next frames in a spool file, to replay them, see `replay`
+
+        The previous spool is dropped.
+
+        :returns: position
+        """
+        if self.spool is not None:
+            self.spool.close()
+        self.spool = tempfile.TemporaryFile(dir=self.spool_dir)
+        self.spooled = []
+        return self.position()
+
+    def replay(self, start, stop):
+        """
+        Write again the frames added between two positions
+
+        :param start: position returned by `mark`
+        :param stop: later position
+        """
+        if stop[1] == start[1]:
+            return
+        self.spool.flush()
+        with self.profiler.stage('write'), \
+                mmap.mmap(self.spool.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for offset, size, times in self.spooled[start[1]:stop[1]]:
+                with memoryview(data)[offset:offset + size] as frame:
+                    for _ in range(times):
+                        self._write(frame)
+            self.nb_frames += stop[0] - start[0]
+            self.profiler.count(frames=stop[0] - start[0])
+
+    def release(self):
+        """
+        The frames since `mark` are no longer replayed: drop the spool
+        """
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+        self.spooled = []
+
+    def add_file(self, path, times=1):
+        """
+        Add a picture file `times` times
+
+        :param path: path to the picture
+        :param times: number of output frames
+        """
+        im = Image.open(path)
+        self.add(letterbox_plan(im.size, self.resolution).apply(im), times)
+
+    def close(self):
+        """
+        Close the encoder input and wait for the movie
+
+        :raises subprocess.CalledProcessError: if the encoder fails
+        """
+        if self.process is None:
+            return
+        try:
+            self._wait()
+        finally:
+            if self.spool is not None:
+                self.spool.close()
+                self.spool = None
+
+    def abort(self):
+        """
+        Kill the encoder and drop the spool, after a failure
+
+        The partial outputs are left to the owner of the sink.
+        """
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+            self.process.kill()
+            self.process.wait()
+            # The reader stops by itself at the end of stderr
+            self.process = None
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+
+    def encode(self, dests, resolution, fps=25, renditions=RENDITIONS, chunks=1):
+        """
+        Finish the movie
+
+        Frames are already in the encoder: `resolution`, `fps` and
+        `renditions` are fixed at the creation of the sink, and the movie
+        can not be encoded in chunks.
+
+        :param dests: path of each rendition
+        :param resolution: movie resolution
+        :param fps: frame per second
+        :param renditions: list of renditions
+        :param chunks: ignored
+        """
+        self.close()
+        for output, dest in zip(self.outputs, dests):
+            # A rename if on the same filesystem
+            shutil.move(output, dest)
+
+
+class Video():
+    """
+    Class to prepare and build a video
+
+    :param resolution:
+    :param tmp_dir: Temp directory path
+    :param mode: 'files' (one png per frame), 'timeline' (one png per distinct
+                 frame with a duration) or 'stream' (raw frames piped to the encoder)
+    :param fps: frame per second
+    :param jobs: number of processes compositing pictures
+    :param cache: FrameCache instance or None
+    :param renditions: list of renditions, see encode_command
+    :param profiler: Profiler instance or None
+    :param chunks: number of chunks encoded in parallel
+    :param executor: process pool executor shared with other videos, see Scheduler
+    :param slide_executor: thread pool executor compiling slides
+    :param work_dir: persistent directory for the frames, to resume a build
+    :param budget: MemoryBudget instance bounding the frames in flight, or None
+    :param frame_format: format of the frames on disk, see FRAME_FORMATS
+    """
+    def __init__(self, resolution, tmp_dir=None, mode='files', fps=25, jobs=1,
+                 cache=None, renditions=RENDITIONS, profiler=None, chunks=1,
+                 executor=None, slide_executor=None, work_dir=None, budget=None,
+                 frame_format='png'):
+        self.work_dir = work_dir
+        self.frame_format = frame_format
+        self.budget = budget
+        if self.work_dir is not None:
+            if mode == 'stream':
+                raise ValueError('A streamed build can not be resumed')
+            # Only the scratch part is deleted
+            os.makedirs(self.work_dir, exist_ok=True)
+            self.tmp_dir = os.path.join(self.work_dir, 'scratch')
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+            os.makedirs(self.tmp_dir)
+        else:
+            # Private directory: several videos can share `tmp_dir`
+            self.tmp_dir = tempfile.mkdtemp(dir=tmp_dir, prefix='videomaker')
+        self.resolution = resolution
+        self.mode = mode
+        self.fps = fps
+        self.jobs = jobs
+        self.cache = cache
+        self.renditions = renditions
+        self.profiler = profiler or Profiler()
+        self.chunks = chunks
+        # tex path -> png file or its future, see prepare_slides
+        self.slides = {}
+        self.own_slide_executor = slide_executor is None
+        if self.own_slide_executor:
+            self.slide_executor = concurrent.futures.ThreadPoolExecutor(max(jobs, 1))
+        else:
+            self.slide_executor = slide_executor
+        # Shut down only the executor owned by this video
+        self.own_executor = executor is None and self.jobs > 1
+        if self.own_executor:
+            self.executor = process_pool(self.jobs, self.budget)
+        else:
+            self.executor = executor
+        if self.executor is None and self.budget is not None:
+            # Pictures are composited in this thread
+            buffer_size = self.budget.buffer_size()
+            if buffer_size is not None:
+                buffer_pool().resize(buffer_size)
+        if self.work_dir is not None:
+            self.pic_dir = os.path.join(self.work_dir, 'frames')
+            os.makedirs(self.pic_dir, exist_ok=True)
+        else:
+            self.pic_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        if self.mode == 'stream':
+            outputs = [os.path.join(self.tmp_dir, 'output%d.%s' %
+                                    (i, rendition_extension(rendition)))
+                       for i, rendition in enumerate(self.renditions)]
+            self.sink = EncoderPipeSink(self.resolution, outputs, fps=self.fps,
+                                        renditions=self.renditions,
+                                        profiler=self.profiler,
+                                        spool_dir=self.tmp_dir)
+        elif self.mode == 'timeline':
+            self.sink = TimelineSink(self.pic_dir, self.profiler,
+                                     persistent=self.work_dir is not None,
+                                     frame_format=self.frame_format,
+                                     resolution=self.resolution)
+        elif self.mode == 'files':
+            self.sink = PictureDirSink(self.pic_dir, self.profiler,
+                                       frame_format=self.frame_format,
+                                       resolution=self.resolution)
+        else:
+            raise ValueError('Wrong mode')
+
+    def __del__(self):
+        if self.own_executor:
+            self.executor.shutdown()
+        if self.own_slide_executor:
+            self.slide_executor.shutdown()
+        logging.debug('Delete the tmp_dir %s' % self.tmp_dir)
+        shutil.rmtree(self.tmp_dir)
+
+    def abort(self):
+        """
+        Stop a failed build: kill the encoder of a streamed video
+        """
+        if self.mode == 'stream':
+            self.sink.abort()
+
+    def prepare_slides(self, paths):
+        """
+        Compile slides in the background, `jobs` at the same time
+
+        The pictures can be composited meanwhile; a slide section waits
+        for its own slide only.
+
+        :param paths: paths to the tex files
+        """
+        self.slides.update(make_slides(paths, self.tmp_dir, self.resolution,
+                                       cache=self.cache, jobs=self.jobs,
+                                       profiler=self.profiler,
+                                       executor=self.slide_executor, wait=False))
+
+    def populate_with_slides(self, path, number):
+        """
+        Add slides to the tmp dir
+
+        :param path: path to the tex file
+        :param number: number of images #FIXME: time?
+        """
+        logger.debug('Populate with slide: %s' %path)
+        if path in self.slides:
+            endfile = self.slides[path]
+            if isinstance(endfile, concurrent.futures.Future):
+                with self.profiler.stage('wait slides'):
+                    endfile = endfile.result()
+            self.sink.add_file(endfile, number)
+            return
+        tmp_path = tempfile.mkdtemp(dir=self.tmp_dir, prefix='tmpSlide')
+        endfile = make_slide(path, tmp_path, self.resolution, cache=self.cache,
+                             profiler=self.profiler)
+        if endfile:
+            self.sink.add_file(endfile, number)
+        shutil.rmtree(tmp_path)
+
+    def populate_with_pictures(self, path, number, repeat, method=Image.NEAREST,
+                               decode='full', crossfade=False, resume=(0, 0),
+                               checkpoint=None, overlay=None, speed=1, stop=None):
+        """
+        Add pictures to the tmp dir
+
+        :param path: path to pictures
+        :param number: output frames per picture
+        :param repeat:
+        :param method: Method to resize images
+        :param decode: decoding mode, see open_picture
+        :param crossfade: blend neighbour pictures for fractional positions
+        :param resume: (repetition, output frame, reference pass) already in the
+                       sink; the reference pass is optional
+        :param checkpoint: function called with (repetition, output frame,
+                           reference pass) after each run
+        :param overlay: overlay section of the configuration, see overlay_text;
+                        'corner', 'size', 'color' and 'shade' are passed to Overlay
+        :param speed: speed of the section, for the overlay
+        :param stop: last output frame of each pass (excluded), the end of the
+                     pass by default
+        """
+        # Angle to rotate each image (for futher improvements)
+        angle = 0
+        pictures = scan_pictures(path)
+        logger.debug('%s output frames per picture' % number)
+
+        # Profiles are not sent back by processes
+        profiler = self.profiler if self.executor is None else None
+        # A frame received from a process, and its pickled copy
+        frame_bytes = 2 * BufferPool.nbytes('RGB', self.resolution)
+        # Cached frames are compressed like the png frames of the sink
+        cache_options = FRAME_FORMATS['png-fast']['options']
+        if self.sink.extension == 'png':
+            cache_options = FRAME_FORMATS[self.frame_format]['options']
+
+        @functools.lru_cache(maxsize=None)
+        def overlay_of(idx):
+            # Same text, same overlay: the run is still one file
+            if not overlay:
+                return None
+            drawn = {name: overlay[name] for name in ('corner', 'size', 'color', 'shade')
+                     if name in overlay}
+            if 'color' in drawn:
+                drawn['color'] = tuple(drawn['color'])
+            drawn['text'] = overlay_text(overlay, pictures[idx], speed)
+            return drawn
+
+        first_rep, first_frame = resume[:2]
+        # Sink positions around a complete pass: all the passes are the same
+        reference = resume[2] if len(resume) > 2 else None
+        for rep in range(first_rep, repeat):
+            if reference is not None:
+                self.sink.replay(*reference)
+                if checkpoint is not None:
+                    checkpoint(rep + 1, 0, reference)
+                continue
+            start = first_frame if rep == first_rep else 0
+            # A pass resumed in the middle can not be replayed
+            begin = self.sink.mark() if start == 0 and rep + 1 < repeat else None
+
+            def lookup():
+                for idx, weight, times in resample(len(pictures), number, crossfade,
+                                                   start=start, stop=stop):
+                    key = None
+                    cached_file = None
+                    # Cross-faded frames are not stored in the cache
+                    if self.cache is not None and not weight:
+                        key = picture_key(pictures[idx], self.resolution, angle, method,
+                                          decode=decode, overlay=overlay_of(idx))
+                        cached_file = self.cache.get(key)
+                    yield idx, weight, times, key, cached_file
+            # Two lazy passes on the same plan: tasks and sink
+            runs, plan = itertools.tee(lookup())
+            # stick the items on a background
+            tasks = ((pictures[idx], pictures[min(idx + 1, len(pictures) - 1)], weight,
+                      self.resolution, angle, method, decode, profiler, overlay_of(idx))
+                     for idx, weight, times, key, cached_file in runs
+                     if cached_file is None)
+            # Two pictures per process in flight: keep workers busy, bound memory
+            frames = ordered_map(render, tasks, self.executor, window=2 * self.jobs,
+                                 budget=self.budget, cost=frame_bytes)
+            if self.executor is not None:
+                frames = self.profiler.timed(frames, 'composite')
+            for idx, weight, times, key, cached_file in plan:
+                logger.debug('Process: %s' % pictures[idx])
+                if cached_file is not None:
+                    self.sink.add_file(cached_file, times)
+                elif key is not None and self.sink.extension == 'png':
+                    # The cached file is linked in the sink
+                    cached_file = self.cache.put(key, next(frames), cache_options)
+                    self.sink.add_file(cached_file, times)
+                elif key is not None:
+                    frame = next(frames)
+                    self.sink.add(frame, times)
+                    self.cache.put(key, frame, cache_options)
+                else:
+                    self.sink.add(next(frames), times)
+                start += times
+                if checkpoint is not None:
+                    checkpoint(rep, start, None)
+            if begin is not None:
+                reference = [begin, self.sink.position()]
+                if checkpoint is not None:
+                    checkpoint(rep + 1, 0, reference)
+        # The next sections are not spooled
+        self.sink.release()
+
+    def encode(self, dests, resolution, fps=25):
+        """
+        Encode the frames, all renditions at once
+
+        :param dests: path of each rendition
+        :param resolution: movie resolution
+        :param fps: frame per second
+        """
+        with self.profiler.stage('encode'):
+            self.sink.encode(dests, resolution, fps, self.renditions, self.chunks)
+
+    def make(self, cwd, output, resolution, fps=25, segments=None):
+        """
+        Build the video, one file per rendition
+
+        :param fps: frame per second
+        :param segments: encoded segments to concatenate instead of the frames,
+                         one list of renditions per segment
+        :returns: paths of the renditions
+        """
+        if segments is not None:
+            return stitch_segments(segments, cwd, output, self.renditions,
+                                   self.tmp_dir, self.profiler)
+        logger.info('Generate the movie...')
+        dests = [os.path.join(cwd, output + '.' + rendition_extension(rendition))
+                 for rendition in self.renditions]
+        remove_outputs(dests)
+        self.encode(dests, resolution, fps)
+        return dests
+
+
+def concat_segments(segments, dest, tmp_dir):
+    """
+    Concatenate encoded segments without re-encoding them
+
+    :param segments: list of movie paths
+    :param dest: path to the movie
+    :param tmp_dir: directory for the list of segments
+    """
+    fd, listfile = tempfile.mkstemp(dir=tmp_dir, prefix='segments', suffix='.txt')
+    try:
+        with os.fdopen(fd, 'w') as seglist:
+            for segment in segments:
+                seglist.write("file '%s'\n" % os.path.abspath(segment).replace("'", "'\\''"))
+        run_command(['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', listfile,
+                     '-c', 'copy', dest])
+    finally:
+        os.remove(listfile)
+
+
+def stitch_segments(segments, cwd, output, renditions=RENDITIONS, tmp_dir=None,
+                    profiler=None):
+    """
+    Concatenate encoded segments in the renditions of a movie
+
+    :param segments: one list of renditions per segment
+    :param cwd: output directory
+    :param output: name of the movie
+    :param renditions: list of renditions, see encode_command
+    :param tmp_dir: directory for the lists of segments
+    :param profiler: Profiler instance or None
+    :returns: paths of the renditions
+    """
+    profiler = profiler or Profiler()
+    logger.info('Generate the movie...')
+    dests = [os.path.join(cwd, output + '.' + rendition_extension(rendition))
+             for rendition in renditions]
+    remove_outputs(dests)
+    with profiler.stage('concat'):
+        for i, dest in enumerate(dests):
+            concat_segments([segment[i] for segment in segments], dest, tmp_dir)
+    return dests
+
+
+def remove_outputs(dests):
+    """
+    Remove the renditions of a previous build, see check_outputs
+
+    :param dests: paths of the renditions
+    """
+    for dest in dests:
+        if os.path.isfile(dest):
+            os.remove(dest)
+
+
+def check_outputs(dests):
+    """
+    Check that the renditions of a movie were written
+
+    :param dests: paths of the renditions
+    :raises OSError: if a rendition is missing or empty
+    """
+    missing = [dest for dest in dests
+               if not os.path.isfile(dest) or os.path.getsize(dest) == 0]
+    if missing:
+        raise OSError(errno.ENOENT, 'Renditions not written: %s' % ', '.join(missing))
+
+
+def populate(vid, subvalue, root_dir, fps=25, method=Image.NEAREST,
+             resume=(0, 0), checkpoint=None, stop=None):
+    """
+    Add the frames of a data section to a video
+
+    :param vid: Video instance
+    :param subvalue: section of the configuration
+    :param root_dir: directory of the configuration file
+    :param fps: frame per second
+    :param method: Method to resize images
+    :param resume: see Video.populate_with_pictures
+    :param checkpoint: see Video.populate_with_pictures
+    :param stop: see Video.populate_with_pictures
+    """
+    if subvalue['type'] == 'tex':
+        duration = subvalue['duration']
+        path = os.path.join(root_dir, subvalue['path'])
+        number = fps * duration
+        vid.populate_with_slides(path, number)
+    elif subvalue['type'] == 'image':
+        path = os.path.join(root_dir, subvalue['path'])
+        inifps = subvalue['inifps']
+        speed = subvalue['speed']
+        repeat = subvalue['repeat']
+        number = fps / inifps / speed
+        decode = subvalue.get('decode', 'full')
+        crossfade = subvalue.get('crossfade', False)
+        vid.populate_with_pictures(path, number, repeat, method, decode, crossfade,
+                                   resume, checkpoint, subvalue.get('overlay'), speed, stop)
+    else:
+        raise ValueError('Wrong type')
+
+
+def plan_section(subvalue, root_dir, fps=25):
+    """
+    Count the output frames and the distinct frames of a data section
+
+    Nothing is decoded: only the pictures are listed.
+
+    :param subvalue: section of the configuration
+    :param root_dir: directory of the configuration file
+    :param fps: frame per second
+    :returns: dict
+    """
+    if subvalue['type'] == 'tex':
+        return {'frames': fps * subvalue['duration'], 'distinct': 1}
+    elif subvalue['type'] == 'image':
+        pictures = scan_pictures(os.path.join(root_dir, subvalue['path']))
+        number = fps / subvalue['inifps'] / subvalue['speed']
+        repeat = subvalue['repeat']
+        crossfade = subvalue.get('crossfade', False)
+        runs = sum(1 for run in resample(len(pictures), number, crossfade))
+        # Repeated passes are links to the first one
+        return {'frames': resample_length(len(pictures), number) * repeat,
+                'distinct': runs}
+    else:
+        raise ValueError('Wrong type')
 
-    :param im: foreground image
-    :param bg: background image
-    :param angle: rotation angle
-    :param method: Method to resize images
+
+def plan_build(data, root_dir, resolution, fps=25, mode='files', frame_format='png'):
     """
-    # Rotate the image
-    if angle != 0:
-        im = im.rotate(angle)
+    Dry run of a build: frames and bytes written in the tmp dir per section
 
-    if im.size == bg.size:
-        # Nothing to hide!
-        return im.copy()
+    Duplicated frames are hard links or durations: only distinct frames
+    take space. In stream mode, only the pass of a repeated section, kept
+    raw in the spool, takes space.
 
-    # Copy to do not overwrite bg
-    wbg = bg.copy()
+    :param data: data section of the configuration
+    :param root_dir: directory of the configuration file
+    :param resolution: movie resolution
+    :param fps: frame per second
+    :param mode: frame storage, see Video
+    :param frame_format: format of the frames, see FRAME_FORMATS
+    :returns: OrderedDict section -> dict (frames, distinct, bytes)
+    """
+    frame_bytes = (resolution[0] * resolution[1]
+                   * FRAME_FORMATS[frame_format]['bytes_per_pixel'])
+    plan = collections.OrderedDict()
+    for name, subvalue in data.items():
+        plan[name] = plan_section(subvalue, root_dir, fps)
+        if mode == 'stream':
+            plan[name]['bytes'] = 0
+            if subvalue['type'] == 'image' and subvalue['repeat'] > 1:
+                # The first pass is spooled as raw RGB frames
+                plan[name]['bytes'] = plan[name]['distinct'] * resolution[0] * resolution[1] * 3
+        else:
+            plan[name]['bytes'] = int(plan[name]['distinct'] * frame_bytes)
+        logger.info('[%s] %d frames, %d distinct, %.1f MB' %
+                    (name, plan[name]['frames'], plan[name]['distinct'],
+                     plan[name]['bytes'] / 1024**2))
+    return plan
 
-    if im.size[1] / im.size[0] > wbg.size[1] / wbg.size[0]:
-        logger.debug('Case 1')
-        # Match size along the vert. dir.
-        ratio = wbg.size[1]/im.size[1]
-        newsize = (math.floor(im.size[0]*ratio), wbg.size[1])
-        box = (math.floor(math.fabs(wbg.size[0]-newsize[0])/2), 0)
+
+def dir_size(path):
+    """
+    Total size of the files of a directory, 0 if it does not exist
+
+    :param path: directory
+    :returns: int
+    """
+    if not os.path.isdir(path):
+        return 0
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+def preflight(plan, tmp_dir=None, policy='fail', margin=1.1, encoders=1, used=0):
+    """
+    Check the free space of the tmp dir against a plan
+
+    :param plan: see plan_build
+    :param tmp_dir: Temp directory path
+    :param policy: if the build does not fit, 'fail', 'stream' (no frame on
+                   disk) or 'chunk' (encode and delete section by section)
+    :param margin: safety factor on the estimate
+    :param encoders: number of sections encoded at the same time, in chunk
+                     mode; one more is rendered meanwhile
+    :param used: bytes of the plan already in the tmp dir, from an interrupted build
+    :returns: None if the build fits, 'stream' or 'chunk' otherwise
+    """
+    free = shutil.disk_usage(tmp_dir or tempfile.gettempdir()).free
+    needed = max(sum(section['bytes'] for section in plan.values()) * margin - used, 0)
+    logger.info('Needs %.1f MB in the tmp dir, %.1f MB free' %
+                (needed / 1024**2, free / 1024**2))
+    if needed <= free:
+        return None
+    sizes = sorted(section['bytes'] for section in plan.values())
+    largest = sum(sizes[-(encoders + 1):]) * margin
+    if policy == 'stream' or (policy == 'chunk' and largest <= free):
+        logger.warning('Not enough space in the tmp dir, switch to %s mode' % policy)
+        return policy
+    raise OSError(errno.ENOSPC, 'Not enough space in the tmp dir: %.1f MB needed, '
+                  '%.1f MB free' % (needed / 1024**2, free / 1024**2))
+
+
+def section_manifest(subvalue, root_dir, resolution, fps=25, method=Image.NEAREST,
+                     mode='files', renditions=RENDITIONS):
+    """
+    Describe the inputs and parameters of a data section
+
+    Two identical manifests give the same encoded segment.
+
+    :param subvalue: section of the configuration
+    :param root_dir: directory of the configuration file
+    :param resolution: movie resolution
+    :param fps: frame per second
+    :param method: Method to resize images
+    :param mode: frame storage, see Video
+    :param renditions: list of renditions, see encode_command
+    :returns: dict
+    """
+    path = os.path.join(root_dir, subvalue['path'])
+    if subvalue['type'] == 'tex':
+        inputs = [path] + tex_dependencies(path)
+    elif subvalue['type'] == 'image':
+        inputs = scan_pictures(path)
     else:
-        logger.debug('Case 2')
-        ratio = wbg.size[0]/im.size[0]
-        newsize = (wbg.size[0], math.floor(im.size[1]*ratio))
-        box = (0, math.floor(math.fabs(wbg.size[1]-im.size[1])/2))
-        box = (0, math.floor(math.fabs(wbg.size[1]-newsize[1])/2))
-
-    logger.debug('im Size: %s' % str(im.size))
-    logger.debug('bg Size: %s' % str(wbg.size))
-    logger.debug('New Size: %s' % str(newsize))
-    logger.debug('Box: %s' % str(box))
-    im = im.resize(newsize, method)
-
-    wbg.paste(im, box=box)
-    return wbg
+        raise ValueError('Wrong type')
+    return {'section': subvalue,
+            'resolution': list(resolution),
+            'fps': fps,
+            'method': method,
+            'mode': mode,
+            'renditions': renditions,
+            'inputs': [file_fingerprint(item) for item in inputs],
+            }
 
 
-def name_it(tmp_path, digits=6):
+def segment_files(build_dir, name, renditions=RENDITIONS):
     """
-    Iterator returning a picture name located in tmp_path
+    Paths of the renditions of a segment
 
-    :param tmp_path:
-    :param digits: number of digits used in the name
-    :returns: iterator
+    :param build_dir: directory storing segments and manifests
+    :param name: section name
+    :param renditions: list of renditions, see encode_command
+    :returns: list of paths
     """
-    i = 0
-    while True:
-        pngfile = os.path.join(tmp_path, str(i).zfill(digits) + '.png')
-        yield(pngfile)
-        i += 1
+    return [os.path.join(build_dir, '%s.%d.%s' % (name, i, rendition_extension(rendition)))
+            for i, rendition in enumerate(renditions)]
 
 
+def segment_is_fresh(build_dir, name, manifest):
+    """
+    Check if the segment of a data section is up to date
 
-##############Natural sorting
+    :param build_dir: directory storing segments and manifests
+    :param name: section name
+    :param manifest: current manifest of the section
+    :returns: boolean
+    """
+    manifest_file = os.path.join(build_dir, name + '.json')
+    segments = segment_files(build_dir, name, manifest['renditions'])
+    if not all(os.path.isfile(item) for item in segments + [manifest_file]):
+        return False
+    with open(manifest_file, 'r') as jsonfile:
+        return json.load(jsonfile) == manifest
+
+
+def render_segment(subvalue, root_dir, resolution, fps=25, method=Image.NEAREST,
+                   slides=None, start=0, stop=None, **kwargs):
+    """
+    Render the frames of a data section in its own video
 
-def tryint(s):
+    A repeated section is rendered once, see encode_segment.
+
+    :param subvalue: section of the configuration
+    :param root_dir: directory of the configuration file
+    :param resolution: movie resolution
+    :param fps: frame per second
+    :param method: Method to resize images
+    :param slides: dict of precompiled slides, see make_slides
+    :param start: first output frame of an image section
+    :param stop: last output frame (excluded) of an image section, its end
+                 by default
+    :param kwargs: passed to Video
+    :returns: Video instance
+    """
+    vid = Video(resolution, fps=fps, **kwargs)
+    if slides:
+        vid.slides.update(slides)
+    if subvalue['type'] == 'image':
+        subvalue = dict(subvalue, repeat=1)
     try:
-        return int(s)
-    except:
-        return s
+        populate(vid, subvalue, root_dir, fps=fps, method=method, resume=(0, start),
+                 stop=stop)
+    except BaseException:
+        vid.abort()
+        raise
+    return vid
 
 
-def alphanum_key(s):
-    """ Turn a string into a list of string and number chunks.
-        "z23a" -> ["z", 23, "a"]
+def encode_segment(vid, name, build_dir, manifest):
     """
-    return [tryint(c) for c in re.split('([0-9]+)', s)]
+    Encode the frames of a data section in its segment
 
-##############Natural sorting : end
+    A repeated section is encoded once, then concatenated with itself
+    without re-encoding.
+
+    :param vid: Video instance, see render_segment
+    :param name: section name
+    :param build_dir: directory storing segments and manifests
+    :param manifest: manifest of the section, stored next to the segment
+    :returns: paths of the renditions of the segment
+    """
+    segments = segment_files(build_dir, name, manifest['renditions'])
+    manifest_file = os.path.join(build_dir, name + '.json')
+    repeat = 1
+    if manifest['section']['type'] == 'image':
+        repeat = manifest['section']['repeat']
+    passes = segment_files(build_dir, name + '.pass', manifest['renditions'])
+    # A stale manifest could mark a segment encoded before as fresh
+    if os.path.isfile(manifest_file):
+        os.remove(manifest_file)
+    try:
+        if repeat > 1:
+            vid.encode(passes, vid.resolution, vid.fps)
+            with vid.profiler.stage('concat'):
+                for one_pass, segment in zip(passes, segments):
+                    concat_segments([one_pass] * repeat, segment, vid.tmp_dir)
+        else:
+            vid.encode(segments, vid.resolution, vid.fps)
+    except Exception:
+        # Partial outputs are not segments
+        for item in segments:
+            if os.path.isfile(item):
+                os.remove(item)
+        raise
+    finally:
+        for one_pass in passes:
+            if os.path.isfile(one_pass):
+                os.remove(one_pass)
+    with open(manifest_file + '.tmp', 'w') as jsonfile:
+        json.dump(manifest, jsonfile)
+    os.replace(manifest_file + '.tmp', manifest_file)
+    return segments
 
 
-def make_slide(tex_path, tmp_path, resolution=(1200, 800)):
+def build_segments(data, root_dir, build_dir, resolution, fps=25,
+                   method=Image.NEAREST, encoders=1, **kwargs):
     """
-    Make introduction png files
+    Encode the data sections in segments, only the ones which changed
 
-    :param tex_path: path to the tex file
-    :param tmp_path: path to a tmp dir
-    :param resolution: picture resolution of the slides
-    :returns: png file path
+    A rendered section is encoded in the background while the next ones
+    are rendered; at most `encoders` sections wait for their encoder.
+
+    :param data: data section of the configuration
+    :param root_dir: directory of the configuration file
+    :param build_dir: directory storing segments and manifests
+    :param resolution: movie resolution
+    :param fps: frame per second
+    :param method: Method to resize images
+    :param encoders: number of sections encoded at the same time
+    :param kwargs: passed to Video
+    :returns: list of segments, each one a list of renditions
     """
-    logger.debug('Build a tex file')
-    resol = str(resolution[0]) + 'x' + str(resolution[1])
+    os.makedirs(build_dir, exist_ok=True)
+    manifests = collections.OrderedDict()
+    for name, subvalue in data.items():
+        manifests[name] = section_manifest(subvalue, root_dir, resolution, fps=fps,
+                                           method=method,
+                                           mode=kwargs.get('mode', 'files'),
+                                           renditions=kwargs.get('renditions',
+                                                                 RENDITIONS))
+    stale = [name for name in data
+             if not segment_is_fresh(build_dir, name, manifests[name])]
 
-    filename = os.path.splitext(os.path.basename(tex_path))[0]
-    #dvifile = os.path.join(tmp_path, filename + '.dvi')
-    pdffile = os.path.join(tmp_path, filename + '.pdf')
-    pngfile = os.path.join(tmp_path, filename + '.png')
+    profiler = kwargs.setdefault('profiler', Profiler())
+    jobs = kwargs.get('jobs', 1)
+    with contextlib.ExitStack() as stack:
+        slide_dir = stack.enter_context(
+            tempfile.TemporaryDirectory(dir=kwargs.get('tmp_dir')))
+        slide_executor = kwargs.get('slide_executor')
+        if slide_executor is None:
+            slide_executor = stack.enter_context(
+                concurrent.futures.ThreadPoolExecutor(max(jobs, 1)))
+        encoder_pool = stack.enter_context(
+            concurrent.futures.ThreadPoolExecutor(max(encoders, 1)))
+        # Compile the slides of all stale sections in the background
+        tex_paths = [os.path.join(root_dir, data[name]['path'])
+                     for name in stale if data[name]['type'] == 'tex']
+        slides = make_slides(tex_paths, slide_dir, resolution,
+                             cache=kwargs.get('cache'), jobs=jobs,
+                             profiler=profiler, executor=slide_executor, wait=False)
+        parent = profiler.path()
 
-    #command = ['/usr/bin/latex', '-output-directory=' + str(tmp_path), str(texfile)]
-    command = ['/usr/bin/pdflatex', '-output-directory=' + str(tmp_path), str(tex_path)]
-    logger.debug('Command: %s' % command)
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = process.communicate()
+        def encode(vid, name):
+            with profiler.attach(parent), profiler.stage(name):
+                return encode_segment(vid, name, build_dir, manifests[name])
 
-    command = ['/usr/bin/convert', '-density', '600', str(pdffile), '-resize', resol,  str(pngfile)]
-    logger.debug('Command: %s' % command)
-    #command = ['/usr/bin/dvipng', '-o', str(pngfile), str(dvifile)]
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = process.communicate()
-    return pngfile
+        segments = []
+        pending = collections.deque()
+        for name, subvalue in data.items():
+            if name in stale:
+                logger.info('[' + name + ']')
+                with profiler.stage(name):
+                    vid = render_segment(subvalue, root_dir, resolution, fps=fps,
+                                         method=method, slides=slides, **kwargs)
+                # Bound the rendered sections waiting on disk
+                while len(pending) >= max(encoders, 1):
+                    pending.popleft().result()
+                future = encoder_pool.submit(encode, vid, name)
+                del vid
+                pending.append(future)
+                segments.append(future)
+            else:
+                logger.info('[' + name + '] up to date')
+                segments.append(segment_files(build_dir, name,
+                                              manifests[name]['renditions']))
+        segments = [segment.result() if isinstance(segment, concurrent.futures.Future)
+                    else segment for segment in segments]
+    return segments
 
 
-class Video():
+class Journal():
     """
-    Class to prepare and build a video
+    Progress of a build, to resume it after an interruption
 
-    :param resolution:
+    Each line of the journal is a json record of a section: its
+    fingerprint, the position of the sink when it started, the last
+    checkpoint and whether it is done. Records are appended and synced; a
+    truncated last line, written during a crash, is ignored.
+
+    :param path: path of the journal
+    :param interval: minimum time between two checkpoints, in seconds
+    """
+    def __init__(self, path, interval=1.):
+        self.path = path
+        self.interval = interval
+        self.last = 0
+        # Last record of each section, in the order of the build
+        self.records = collections.OrderedDict()
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.warning('Ignore a truncated record of %s' % self.path)
+                        break
+                    self.records[record['section']] = record
+
+    def _append(self, record):
+        self.records[record['section']] = record
+        with open(self.path, 'a') as journal:
+            journal.write(json.dumps(record) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def rewrite(self, records):
+        """
+        Replace the journal by some records
+
+        :param records: list of records kept
+        """
+        self.records = collections.OrderedDict((record['section'], record)
+                                               for record in records)
+        with open(self.path + '.tmp', 'w') as journal:
+            for record in records:
+                journal.write(json.dumps(record) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(self.path + '.tmp', self.path)
+
+    def checkpoint(self, section, fingerprint, start, position, resume, force=False):
+        """
+        Record the progress of a section, at most once per interval
+
+        :param section: section name
+        :param fingerprint: fingerprint of the section
+        :param start: position of the sink when the section started
+        :param position: current position of the sink
+        :param resume: arguments to resume the section, see populate
+        :param force: ignore the interval
+        """
+        now = time.monotonic()
+        if not force and now - self.last < self.interval:
+            return
+        self.last = now
+        self._append({'section': section, 'fingerprint': fingerprint, 'start': start,
+                      'position': position, 'resume': list(resume), 'done': False})
+
+    def done(self, section, fingerprint, start, position):
+        """
+        Record a finished section
+
+        :param section: section name
+        :param fingerprint: fingerprint of the section
+        :param start: position of the sink when the section started
+        :param position: position of the sink at the end of the section
+        """
+        self._append({'section': section, 'fingerprint': fingerprint, 'start': start,
+                      'position': position, 'resume': None, 'done': True})
+
+
+def populate_all(vid, data, root_dir, fps=25, method=Image.NEAREST, journal=None):
+    """
+    Add the frames of all data sections to a video
+
+    With a journal, the sections rendered by a previous run are kept, the
+    interrupted one restarts from its last checkpoint and the next ones
+    are rendered again.
+
+    :param vid: Video instance
+    :param data: data section of the configuration
+    :param root_dir: directory of the configuration file
+    :param fps: frame per second
+    :param method: Method to resize images
+    :param journal: Journal instance or None
+    """
+    if journal is None:
+        for name, subvalue in data.items():
+            logger.info('[' + name + ']')
+            with vid.profiler.stage(name):
+                populate(vid, subvalue, root_dir, fps=fps, method=method)
+        return
+
+    completed = []
+    resuming = True
+    for name, subvalue in data.items():
+        logger.info('[' + name + ']')
+        manifest = section_manifest(subvalue, root_dir, vid.resolution, fps=fps,
+                                    method=method, mode=vid.mode,
+                                    renditions=vid.renditions)
+        # Frames of another format are not reused
+        fingerprint = FrameCache.key(manifest, vid.frame_format)
+        start = vid.sink.position()
+        record = journal.records.get(name) if resuming else None
+        resume = (0, 0)
+        if (record is not None and record['fingerprint'] == fingerprint
+                and record['start'] == start and vid.sink.verify(record['position'])):
+            vid.sink.seek(record['position'])
+            if record['done']:
+                logger.info('[%s] already rendered' % name)
+                completed.append(record)
+                continue
+            resume = tuple(record['resume'])
+            logger.info('[%s] resume at frame %d of repetition %d' %
+                        (name, resume[1], resume[0]))
+            journal.rewrite(completed + [record])
+        else:
+            # Frames of a previous run after this point are stale
+            vid.sink.seek(start)
+            journal.rewrite(completed)
+        resuming = False
+
+        def checkpoint(rep, frame, reference):
+            # Replayed passes are recorded: they are not rendered again
+            journal.checkpoint(name, fingerprint, start, vid.sink.position(),
+                               (rep, frame, reference), force=reference is not None)
+
+        with vid.profiler.stage(name):
+            populate(vid, subvalue, root_dir, fps=fps, method=method,
+                     resume=resume, checkpoint=checkpoint)
+        journal.done(name, fingerprint, start, vid.sink.position())
+
+
+# Output frames of a shard of an image section: one minute at 25 fps
+SHARD_FRAMES = 1500
+
+
+def plan_shards(data, root_dir, resolution, fps=25, method=Image.NEAREST,
+                renditions=RENDITIONS, shard_frames=SHARD_FRAMES):
+    """
+    Cut the data sections in shards rendered and encoded independently
+
+    A shard is a range of output frames of one pass of an image section,
+    or a whole slide section. Its key depends on the section name, its
+    content, its inputs and the range, so that a shard encoded by a
+    previous build is kept. Two identical sections have their own shards.
+
+    :param data: data section of the configuration
+    :param root_dir: directory of the configuration file
+    :param resolution: movie resolution
+    :param fps: frame per second
+    :param method: Method to resize images
+    :param renditions: list of renditions, see encode_command
+    :param shard_frames: output frames per shard
+    :returns: list of dicts (key, section, start, stop), in the movie order
+    """
+    shards = []
+    for name, subvalue in data.items():
+        manifest = section_manifest(subvalue, root_dir, resolution, fps=fps,
+                                    method=method, renditions=renditions)
+        bounds = [(0, None)]
+        if subvalue['type'] == 'image':
+            number = fps / subvalue['inifps'] / subvalue['speed']
+            length = resample_length(len(manifest['inputs']), number)
+            bounds = [(start, min(start + shard_frames, length))
+                      for start in range(0, length, shard_frames)]
+        for start, stop in bounds:
+            shards.append({'key': FrameCache.key(name, manifest, start, stop),
+                           'section': name, 'start': start, 'stop': stop})
+    return shards
+
+
+class ShardQueue():
+    """
+    Shards of a build shared by a coordinator and its workers
+
+    The queue is a SQLite database in a directory, next to the encoded
+    segments of the shards: workers of other hosts join it through a
+    shared file system. A worker renews the lease of its shard while it
+    renders it; a shard whose lease expired, because its worker died or
+    lost the shared file system, is given to another one. Each claim is an
+    attempt: only the worker of the last attempt of a shard records it.
+
+    :param path: directory of the queue
+    :param lease: time to render and encode a shard, in seconds
+    """
+    def __init__(self, path, lease=3600):
+        self.path = path
+        self.lease = lease
+        self.segment_dir = os.path.join(path, 'segments')
+        os.makedirs(self.segment_dir, exist_ok=True)
+        self.db_path = os.path.join(path, 'queue.sqlite')
+        with self._transaction() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS build (id INTEGER PRIMARY KEY, config TEXT)')
+            db.execute('CREATE TABLE IF NOT EXISTS shards (key TEXT PRIMARY KEY, rank INTEGER, '
+                       'spec TEXT, state TEXT, worker TEXT, claimed REAL, '
+                       'attempts INTEGER DEFAULT 0, error TEXT)')
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # One connection per transaction: processes do not share connections
+        db = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+        try:
+            # Lock the queue for writing now, not at the first update
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+        finally:
+            db.close()
+
+    def segments(self, key, renditions, attempt=None):
+        """
+        Paths of the renditions of a shard
+
+        :param key: key of the shard
+        :param renditions: list of renditions, see encode_command
+        :param attempt: attempt of a worker, see claim, for the files it
+                        encodes before `finish`
+        :returns: list of paths
+        """
+        if attempt is not None:
+            key = '%s.part%d' % (key, attempt)
+        return segment_files(self.segment_dir, key, renditions)
+
+    def submit(self, config, shards):
+        """
+        Replace the build of the queue
+
+        Shards already encoded are kept, the other ones are pending.
+
+        :param config: dict (root_dir, data, resolution, fps, method,
+                       renditions) shared with the workers
+        :param shards: see plan_shards
+        :returns: number of shards kept
+        """
+        kept = 0
+        with self._transaction() as db:
+            db.execute('INSERT OR REPLACE INTO build VALUES (0, ?)', (json.dumps(config),))
+            done = {key for key, in db.execute("SELECT key FROM shards WHERE state = 'done'")}
+            db.execute('DELETE FROM shards')
+            for rank, shard in enumerate(shards):
+                state = 'pending'
+                if (shard['key'] in done and
+                        all(os.path.isfile(item) for item in
+                            self.segments(shard['key'], config['renditions']))):
+                    state = 'done'
+                    kept += 1
+                db.execute('INSERT INTO shards (key, rank, spec, state) VALUES (?, ?, ?, ?)',
+                           (shard['key'], rank, json.dumps(shard), state))
+        return kept
+
+    def config(self):
+        """
+        Build of the queue
+
+        :returns: dict, see submit
+        """
+        with self._transaction() as db:
+            row = db.execute('SELECT config FROM build WHERE id = 0').fetchone()
+        if row is None:
+            raise ValueError('No build in the queue %s' % self.path)
+        return json.loads(row[0])
+
+    def claim(self, worker):
+        """
+        Take the first pending shard, or one whose lease expired
+
+        :param worker: name of the worker
+        :returns: shard, see plan_shards, with its 'attempt', or None
+        """
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute("SELECT key, spec, attempts FROM shards WHERE state = 'pending' "
+                             "OR (state = 'running' AND claimed < ?) ORDER BY rank LIMIT 1",
+                             (now - self.lease,)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE shards SET state = 'running', worker = ?, claimed = ?, "
+                       "attempts = attempts + 1 WHERE key = ?", (worker, now, row[0]))
+        return dict(json.loads(row[1]), attempt=row[2] + 1)
+
+    def _owned(self, db, key, attempt):
+        row = db.execute("SELECT 1 FROM shards WHERE key = ? AND state = 'running' "
+                         "AND attempts = ?", (key, attempt)).fetchone()
+        return row is not None
+
+    def renew(self, key, attempt):
+        """
+        Extend the lease of a shard
+
+        :param key: key of the shard
+        :param attempt: attempt returned by claim
+        :returns: False if the shard was given to another worker
+        """
+        with self._transaction() as db:
+            if not self._owned(db, key, attempt):
+                return False
+            db.execute('UPDATE shards SET claimed = ? WHERE key = ?', (time.time(), key))
+        return True
+
+    def finish(self, key, attempt, renditions):
+        """
+        Record an encoded shard: its files become its segments
+
+        :param key: key of the shard
+        :param attempt: attempt returned by claim
+        :param renditions: list of renditions, see encode_command
+        :returns: False if the shard was given to another worker, whose
+                  segments are kept
+        """
+        with self._transaction() as db:
+            if not self._owned(db, key, attempt):
+                return False
+            # Under the lock of the queue: no other attempt is recorded meanwhile
+            for part, segment in zip(self.segments(key, renditions, attempt),
+                                     self.segments(key, renditions)):
+                os.replace(part, segment)
+            db.execute("UPDATE shards SET state = 'done', error = NULL WHERE key = ?", (key,))
+        return True
+
+    def fail(self, key, attempt, error):
+        """
+        Record a failed shard, pending again at the next submit
+
+        :param key: key of the shard
+        :param attempt: attempt returned by claim
+        :param error: error message
+        :returns: False if the shard was given to another worker
+        """
+        with self._transaction() as db:
+            if not self._owned(db, key, attempt):
+                return False
+            db.execute("UPDATE shards SET state = 'failed', error = ? WHERE key = ?",
+                       (error, key))
+        return True
+
+    def counts(self):
+        """
+        Number of shards per state: pending, running, done, failed
+
+        :returns: dict
+        """
+        with self._transaction() as db:
+            return dict(db.execute('SELECT state, COUNT(*) FROM shards GROUP BY state'))
+
+    def errors(self):
+        """
+        Failed shards
+
+        :returns: list of (shard, worker, error)
+        """
+        with self._transaction() as db:
+            rows = db.execute("SELECT spec, worker, error FROM shards WHERE state = 'failed' "
+                              "ORDER BY rank").fetchall()
+        return [(json.loads(spec), worker, error) for spec, worker, error in rows]
+
+
+def render_shard(queue, shard, config, **kwargs):
+    """
+    Render and encode a shard in the files of its attempt
+
+    The files become the segment of the shard at ShardQueue.finish.
+
+    :param queue: ShardQueue instance
+    :param shard: shard returned by ShardQueue.claim
+    :param config: build of the queue, see ShardQueue.submit
+    :param kwargs: passed to Video
+    :returns: paths of the renditions
+    :raises subprocess.CalledProcessError: if the encoder fails
+    """
+    subvalue = config['data'][shard['section']]
+    vid = render_segment(subvalue, config['root_dir'], config['resolution'],
+                         fps=config['fps'], method=config['method'], start=shard['start'],
+                         stop=shard['stop'], renditions=config['renditions'], **kwargs)
+    parts = queue.segments(shard['key'], config['renditions'], shard['attempt'])
+    try:
+        vid.encode(parts, vid.resolution, vid.fps)
+    except Exception:
+        remove_parts(parts)
+        raise
+    return parts
+
+
+def remove_parts(parts):
+    """
+    Remove the files of an attempt which is not recorded
+
+    :param parts: paths, see render_shard
+    """
+    for item in parts:
+        if os.path.isfile(item):
+            os.remove(item)
+
+
+def renew_lease(queue, shard, stop):
+    """
+    Renew the lease of a shard until `stop` is set or the shard is lost
+
+    :param queue: ShardQueue instance
+    :param shard: shard returned by ShardQueue.claim
+    :param stop: threading.Event
+    """
+    while not stop.wait(queue.lease / 3):
+        if not queue.renew(shard['key'], shard['attempt']):
+            logger.warning('[%s] shard given to another worker' % shard['section'])
+            return
+
+
+def run_worker(queue_dir, worker=None, poll=5., lease=3600, **kwargs):
+    """
+    Render the shards of a queue until none is left
+
+    A failed shard is recorded in the queue and the worker goes on with
+    the next one. The worker waits for the shards claimed by others, to
+    take them over if their lease expires.
+
+    :param queue_dir: directory of the queue, see ShardQueue
+    :param worker: name of the worker, host and process id by default
+    :param poll: time between two looks at the queue, in seconds
+    :param lease: see ShardQueue
+    :param kwargs: passed to Video
+    :returns: number of shards rendered
+    """
+    worker = worker or '%s:%d' % (socket.gethostname(), os.getpid())
+    queue = ShardQueue(queue_dir, lease=lease)
+    config = queue.config()
+    rendered = 0
+    while True:
+        shard = queue.claim(worker)
+        if shard is None:
+            if not queue.counts().get('running'):
+                return rendered
+            time.sleep(poll)
+            continue
+        logger.info('[%s] frames %d to %s on %s' %
+                    (shard['section'], shard['start'], shard['stop'], worker))
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=renew_lease, args=(queue, shard, stop),
+                                     daemon=True)
+        heartbeat.start()
+        try:
+            parts = render_shard(queue, shard, config, **kwargs)
+        except Exception as err:
+            logger.error('[%s] shard failed: %s' % (shard['section'], err))
+            queue.fail(shard['key'], shard['attempt'], repr(err))
+            continue
+        finally:
+            stop.set()
+            heartbeat.join()
+        if queue.finish(shard['key'], shard['attempt'], config['renditions']):
+            rendered += 1
+        else:
+            # Another worker took the shard over: its segments are kept
+            remove_parts(parts)
+
+
+def build_sharded(config, cwd, shard_dir, fps=25, method=Image.NEAREST, workers=1,
+                  shard_frames=SHARD_FRAMES, tmp_dir=None, profiler=None, poll=5.,
+                  **kwargs):
+    """
+    Build a movie from shards rendered by worker processes, then stitch it
+
+    The coordinator plans the shards in a queue, starts `workers` local
+    workers (other hosts may join with run_worker) and concatenates the
+    encoded segments without re-encoding. Shards encoded by a previous
+    build of the queue are kept.
+
+    :param config: see load_config
+    :param cwd: output directory
+    :param shard_dir: directory of the queue, see ShardQueue
+    :param fps: frame per second
+    :param method: Method to resize images
+    :param workers: number of local workers, 0 to wait for remote ones only
+    :param shard_frames: output frames per shard
     :param tmp_dir: Temp directory path
+    :param profiler: Profiler instance or None
+    :param poll: time between two looks at the queue, in seconds
+    :param kwargs: passed to Video by the local workers
+    :returns: paths of the renditions
     """
-    def __init__(self, resolution, tmp_dir=None):
-        self.tmp_dir = tmp_dir
-        self.resolution = resolution
-        self.pic_dir = tempfile.mkdtemp(dir=self.tmp_dir)
-        self.generator = name_it(self.pic_dir)
+    profiler = profiler or Profiler()
+    data = config['data']
+    renditions = config['renditions']
+    shards = plan_shards(data, config['root_dir'], config['resolution'], fps=fps,
+                         method=method, renditions=renditions, shard_frames=shard_frames)
+    queue = ShardQueue(shard_dir)
+    kept = queue.submit({'root_dir': config['root_dir'], 'data': data,
+                         'resolution': list(config['resolution']), 'fps': fps,
+                         'method': method, 'renditions': renditions}, shards)
+    logger.info('%d shards, %d already encoded' % (len(shards), kept))
 
-    def __del__(self):
-        #Delete the self.pic_dir
-        logging.debug('Delete the tmp_dir %s' % self.pic_dir)
-        shutil.rmtree(self.pic_dir)
-        logging.debug('Delete the tmp_dir %s' % self.tmp_dir)
-        shutil.rmtree(self.tmp_dir)
+    with contextlib.ExitStack() as stack, profiler.stage('shards'):
+        futures = []
+        if workers > 0:
+            pool = stack.enter_context(process_pool(workers))
+            futures = [pool.submit(run_worker, shard_dir, worker='local%d' % i, poll=poll,
+                                   tmp_dir=tmp_dir, **kwargs)
+                       for i in range(workers)]
+        last = None
+        while True:
+            counts = queue.counts()
+            if counts != last:
+                logger.info('Shards: %d done, %d running, %d pending, %d failed' %
+                            tuple(counts.get(state, 0)
+                                  for state in ('done', 'running', 'pending', 'failed')))
+                last = counts
+            if not counts.get('pending') and not counts.get('running'):
+                break
+            for future in futures:
+                if future.done():
+                    # A worker which crashed
+                    future.result()
+            time.sleep(poll)
+    errors = queue.errors()
+    if errors:
+        for shard, worker, error in errors:
+            logger.error('[%s] frames %d to %s failed on %s: %s' %
+                         (shard['section'], shard['start'], shard['stop'], worker, error))
+        raise RuntimeError('%d shards failed, run the build again to retry them' %
+                           len(errors))
 
-    def populate_with_slides(self, path, number):
+    # Repeated sections list the shards of one pass again
+    segments = []
+    for name, subvalue in data.items():
+        repeat = subvalue['repeat'] if subvalue['type'] == 'image' else 1
+        keys = [shard['key'] for shard in shards if shard['section'] == name]
+        segments.extend(queue.segments(key, renditions) for key in keys * repeat)
+    return stitch_segments(segments, cwd, config['output'], renditions, tmp_dir, profiler)
+
+
+# Frame per second of the movies
+FPS = 25
+JSON_VERSION = '0.1.1'
+
+# Proxy build to check the timing and the order of the sections
+PREVIEW = {'width': 320,
+           'fps': 5,
+           'method': Image.NEAREST,
+           'decode': 'fast',
+           'frame_format': 'raw',
+           'renditions': [{'profile': 'x264', 'preset': 'ultrafast',
+                           'options': ['-crf', '32', '-pix_fmt', 'yuv420p']}],
+           }
+
+
+def preview_config(config, preview=PREVIEW):
+    """
+    Configuration of the preview of a movie
+
+    The resolution is reduced to the preview width, with even sizes for
+    the encoder, and pictures are decoded at a reduced size.
+
+    :param config: see load_config
+    :param preview: preview settings
+    :returns: dict, see load_config
+    """
+    width, height = config['resolution']
+    proxy_width = min(preview['width'], width)
+    proxy_height = round(height * proxy_width / width)
+    data = collections.OrderedDict()
+    for name, subvalue in config['data'].items():
+        if subvalue['type'] == 'image':
+            subvalue = dict(subvalue, decode=preview['decode'])
+        data[name] = subvalue
+    return dict(config,
+                output=config['output'] + '.preview',
+                resolution=(proxy_width - proxy_width % 2, proxy_height - proxy_height % 2),
+                renditions=preview['renditions'],
+                data=data)
+
+
+def load_config(conf_path):
+    """
+    Read a configuration file
+
+    :param conf_path: path to the json file
+    :returns: dict (output, resolution, renditions, data, root_dir)
+    """
+    root_dir = os.path.split(os.path.abspath(conf_path))[0]
+    logger.debug('root_dir: %s' % root_dir)
+    config = {'root_dir': root_dir, 'renditions': RENDITIONS}
+    with open(conf_path, 'r') as jsonfile:
+        conf = json.load(jsonfile, object_pairs_hook=collections.OrderedDict)
+    for section, value in conf.items():
+        if section == 'meta':
+            logger.debug('detected json version: ' + str(value['jsonversion']))
+            if not value['jsonversion'] == JSON_VERSION:
+                #FIXME: look for a better exception
+                raise ValueError('Your jsonfile does not look to be at the correct version')
+        if section == 'movie':
+            config['output'] = value['output']
+            config['resolution'] = (value['hor_resolution'], value['ver_resolution'])
+            config['renditions'] = value.get('renditions', RENDITIONS)
+        if section == 'data':
+            config['data'] = value
+    return config
+
+
+def build(conf_path, cwd=None, tmp_dir=None, mode='files', jobs=1, cache=None,
+          build_dir=None, low_disk='fail', chunks=1, dry_run=False, progress=False,
+          method=Image.BICUBIC, executor=None, slide_executor=None, work_dir=None,
+          encoders=1, budget=None, frame_format='png', preview=False, shard_dir=None,
+          workers=1, shard_frames=SHARD_FRAMES):
+    """
+    Build the movie described by a configuration file
+
+    :param conf_path: path to the json file
+    :param cwd: output directory, the current one by default
+    :param tmp_dir: Temp directory path
+    :param mode: frame storage, see Video
+    :param jobs: number of processes compositing pictures
+    :param cache: FrameCache instance or None
+    :param build_dir: directory of the encoded sections (incremental build)
+    :param low_disk: policy if the tmp dir is too small, see preflight
+    :param chunks: number of chunks encoded in parallel
+    :param dry_run: only plan the build
+    :param progress: show the number of frames per second
+    :param method: Method to resize images
+    :param executor: process pool executor shared between builds
+    :param slide_executor: thread pool executor compiling slides
+    :param work_dir: directory of the frames and the journal, to resume the build
+    :param encoders: number of sections encoded while the next ones are
+                     rendered, in an incremental or chunked build
+    :param budget: MemoryBudget instance bounding the frames in flight, may
+                   be shared by several builds
+    :param frame_format: format of the frames on disk, see FRAME_FORMATS
+    :param preview: fast build at a low resolution and frame rate, see PREVIEW;
+                    its cache, build, work and shard directories are separate
+    :param shard_dir: directory of the shard queue, for a sharded build, see
+                      build_sharded
+    :param workers: number of local workers of a sharded build
+    :param shard_frames: output frames per shard
+    :returns: paths of the renditions, None for a dry run
+    :raises OSError: if a rendition is not written, see check_outputs
+    :raises subprocess.CalledProcessError: if a tool fails
+    """
+    cwd = cwd or os.getcwd()
+    profiler = Profiler(progress=progress)
+
+    logger.info('Preparing...')
+    config = load_config(conf_path)
+    fps = FPS
+    if preview:
+        config = preview_config(config)
+        fps = PREVIEW['fps']
+        method = PREVIEW['method']
+        if frame_format == 'png':
+            frame_format = PREVIEW['frame_format']
+        if cache is not None:
+            cache = cache.namespace('preview')
+        if build_dir:
+            build_dir = os.path.join(build_dir, 'preview')
+        if work_dir:
+            work_dir = os.path.join(work_dir, 'preview')
+        if shard_dir:
+            shard_dir = os.path.join(shard_dir, 'preview')
+    root_dir = config['root_dir']
+    data = config['data']
+    output = config['output']
+    resolution = config['resolution']
+    renditions = config['renditions']
+
+    plan = plan_build(data, root_dir, resolution, fps=fps, mode=mode,
+                      frame_format=frame_format)
+    if dry_run:
+        return None
+    if shard_dir:
+        if build_dir or work_dir:
+            # Encoded shards are already kept
+            logger.warning('The build and work dirs are not used with a sharded build')
+        # The workers run in their own processes
+        dests = build_sharded(config, cwd, shard_dir, fps=fps, method=method,
+                              workers=workers, shard_frames=shard_frames,
+                              tmp_dir=tmp_dir, profiler=profiler, mode=mode, jobs=jobs,
+                              cache=cache, frame_format=frame_format)
+        check_outputs(dests)
+        profiler.write(os.path.join(cwd, output + '.report.json'))
+        return dests
+    chunk_dir = None
+    if work_dir and build_dir:
+        # Segments are already kept: a build resumes at the interrupted one
+        logger.warning('The work dir is not used with an incremental build')
+        work_dir = None
+    if build_dir is None and work_dir is None:
+        fallback = preflight(plan, tmp_dir, policy=low_disk, encoders=encoders)
+        if fallback == 'stream':
+            mode = 'stream'
+        elif fallback == 'chunk':
+            # Sections are encoded then deleted one after the other
+            chunk_dir = build_dir = tempfile.mkdtemp(dir=tmp_dir, prefix='chunks')
+    elif work_dir:
+        # The frames are kept in the work dir: no fallback, and the frames of
+        # an interrupted build are already counted in the free space
+        os.makedirs(work_dir, exist_ok=True)
+        preflight(plan, work_dir, encoders=encoders,
+                  used=dir_size(os.path.join(work_dir, 'frames')))
+
+    own_executor = executor is None and jobs > 1
+    if own_executor:
+        # One pool for all the sections
+        executor = process_pool(jobs, budget)
+    options = {'tmp_dir': tmp_dir, 'mode': mode, 'jobs': jobs, 'cache': cache,
+               'renditions': renditions, 'profiler': profiler, 'chunks': chunks,
+               'executor': executor, 'slide_executor': slide_executor,
+               'budget': budget, 'frame_format': frame_format}
+    try:
+        if build_dir:
+            segments = build_segments(data, root_dir, build_dir, resolution,
+                                      fps=fps, method=method, encoders=encoders,
+                                      **options)
+            dests = stitch_segments(segments, cwd, output, renditions, tmp_dir, profiler)
+        else:
+            vid = Video(resolution, fps=fps, work_dir=work_dir, **options)
+            # Compile the slides while the pictures are composited
+            vid.prepare_slides([os.path.join(root_dir, subvalue['path'])
+                                for subvalue in data.values()
+                                if subvalue['type'] == 'tex'])
+            journal = None
+            if work_dir:
+                journal = Journal(os.path.join(work_dir, 'journal.jsonl'))
+            try:
+                populate_all(vid, data, root_dir, fps=fps, method=method,
+                             journal=journal)
+            except BaseException:
+                vid.abort()
+                raise
+            dests = vid.make(cwd, output=output, fps=fps, resolution=resolution)
+        check_outputs(dests)
+    finally:
+        if own_executor:
+            executor.shutdown()
+        if chunk_dir:
+            shutil.rmtree(chunk_dir, ignore_errors=True)
+    profiler.write(os.path.join(cwd, output + '.report.json'))
+    return dests
+
+
+class Scheduler():
+    """
+    Build many movies in one process with shared resources
+
+    All builds share the compositing processes, the slide threads and the
+    frame cache; at most `max_builds` run at the same time.
+
+    :param jobs: number of processes compositing pictures, for all builds
+    :param max_builds: number of builds running at the same time
+    :param cache: FrameCache instance or None
+    :param budget: MemoryBudget instance shared by all builds, or None
+    """
+    def __init__(self, jobs=1, max_builds=1, cache=None, budget=None):
+        self.jobs = jobs
+        self.cache = cache
+        self.budget = budget
+        self.executor = None
+        if self.jobs > 1:
+            self.executor = process_pool(self.jobs, self.budget)
+        self.slide_executor = concurrent.futures.ThreadPoolExecutor(max(jobs, 1))
+        self.builds = concurrent.futures.ThreadPoolExecutor(max_builds)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
         """
-        Add slides to the tmp dir
+        Wait for the builds and stop the pools
+        """
+        self.builds.shutdown()
+        self.slide_executor.shutdown()
+        if self.executor is not None:
+            self.executor.shutdown()
 
-        :param path: path to the tex file
-        :param number: number of images #FIXME: time?
+    def submit(self, conf_path, **kwargs):
         """
-        logger.debug('Populate with slide: %s' %path)
-        tmp_path = tempfile.mkdtemp(dir=self.tmp_dir, prefix='tmpSlide')
-        endfile = make_slide(path, tmp_path, self.resolution)
-        if endfile:
-            for count in range(number):
-                shutil.copy(endfile, self.generator.__next__())
-        shutil.rmtree(tmp_path)
+        Schedule a build
 
-    def populate_with_pictures(self, path, number, repeat, method=Image.NEAREST):
+        :param conf_path: path to the json file
+        :param kwargs: passed to build
+        :returns: future of the paths of the renditions
         """
-        Add pictures to the tmp dir
+        return self.builds.submit(build, conf_path, jobs=self.jobs, cache=self.cache,
+                                  executor=self.executor, budget=self.budget,
+                                  slide_executor=self.slide_executor, **kwargs)
 
-        :param path: path to pictures
-        :param number:
-        :param repeat:
-        :param method: Method to resize images
+    def run(self, conf_paths, **kwargs):
         """
-        # Background: auto-generated for the moment
-        bg = Image.new("RGB", resolution, color=(0, 0, 0)) # Black.
-        # Angle to rotate each image (for futher improvements)
-        angle = 0
-        pictures = sorted(os.listdir(path), key=alphanum_key)
-        pictures = [os.path.join(path, item) for item in pictures]
-        # TODO: make sure each file is a picture
-
-        tmp_file = tempfile.mkstemp(dir=self.tmp_dir, prefix='tmpImage', suffix='.png')[1]
-        if number >= 1:
-            gen_dest = None
-            # duplicate the picture...
-            times = math.floor(number)
-            logger.debug('Duplicate %s times' % times)
-            for rep in range(repeat):
-                for item in pictures:
-                    logger.debug('Process: %s' % item)
-                    # stick the item on a background
-                    full_im = Image.open(item)
-                    full_im = add_bg(full_im, bg, angle=angle, method=method)
-                    full_im.save(tmp_file)
-                    for time in range(times):
-                        prev_gen_dest = gen_dest
-                        gen_dest = self.generator.__next__()
-                        if time == 0:
-                            # First time, copy
-                            shutil.copy(tmp_file, gen_dest)
-                        else:
-                            # Duplicate and preserve disk space
-                            os.link(prev_gen_dest, gen_dest)
-        elif number < 1:
-            # pick one every...
-            every = math.floor(1 / number)
-            logger.debug('Use 1 image every %s' % every)
-            for rep in range(repeat):
-                for item in pictures[::every]:
-                    logger.debug('Process: %s' % item)
-                    # stick the item on a background
-                    full_im = Image.open(item)
-                    full_im = add_bg(full_im, bg, angle=angle, method=method)
-                    full_im.save(tmp_file)
-                    shutil.copy(tmp_file, self.generator.__next__())
-        os.remove(tmp_file)
-
-    def make(self, cwd, output, resolution, fps=25):
-        """
-        Build the video (avi + ogv)
+        Build several movies; a failed build does not stop the others
 
-        :param fps: frame per second
+        :param conf_paths: paths to the json files
+        :param kwargs: passed to build
+        :returns: OrderedDict conf path -> paths of the renditions or exception
         """
+        futures = collections.OrderedDict((conf_path, self.submit(conf_path, **kwargs))
+                                          for conf_path in conf_paths)
+        results = collections.OrderedDict()
+        for conf_path, future in futures.items():
+            try:
+                results[conf_path] = future.result()
+            except Exception as err:
+                logger.error('%s failed: %s' % (conf_path, err))
+                results[conf_path] = err
+        return results
 
-        logger.info('Generate the movie...')
-        os.chdir(self.pic_dir)
-
-        # Encode the movie (avi)
-        logger.info('[avi]')
-        command = ['mencoder', 'mf://*.png', '-mf', 'fps='+str(fps),
-                   '-vf', 'scale='+str(resolution[0])+':'+str(resolution[1]),
-                   '-o', 'output.avi',
-                   '-ovc', 'xvid',
-                   '-xvidencopts', 'bitrate=2048'
-                   ]
-        logging.debug('command: ' + str(command))
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
-        logging.debug(stdout.decode('utf8'))
-        logging.warning(stderr.decode('utf8'))
-
-
-        # Encode the movie (ogv)
-        logger.info('[ogv]')
-        command = ['ffmpeg',
-                   '-i', 'output.avi',
-                   '-s', '448x336',
-                   '-f', 'ogg',
-                   '-vcodec', 'libtheora',
-                   '-acodec', 'libvorbis',
-                   '-b:v', '900k',
-                   '-b:a', '128k',
-                   'output.ogv']
-        logging.debug('command: ' + str(command))
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
-        logging.debug(stdout.decode('utf8'))
-        logging.warning(stderr.decode('utf8'))
-
-        #Copy the movie
-        for ext in ('.avi', '.ogv'):
-            logging.debug('Move output%s to %s', (ext, cwd))
-            shutil.copy('output' + ext, os.path.join(cwd, output + ext))
 
+def main(argv=None):
+    """
+    Command line interface
 
-if __name__ == '__main__':
+    :param argv: arguments, sys.argv by default
+    :returns: exit code
+    """
     parser = argparse.ArgumentParser(description='', epilog='')
-    parser.add_argument('conf', help='Configuration file', metavar='CONF')
+    parser.add_argument('conf', nargs='*', metavar='CONF',
+                        help='Configuration file, several ones for a batch')
     parser.add_argument('-t', '--tmp', metavar='TMP',
                         default=None, help='Directery where are stored tmp files')
     parser.add_argument('-d', '--debug', action='store_true',
                         default=False, help='Run in debug mode')
+    parser.add_argument('-s', '--stream', action='store_const', dest='mode',
+                        const='stream', default='files',
+                        help='Stream frames to the encoder, no png files')
+    parser.add_argument('--timeline', action='store_const', dest='mode',
+                        const='timeline',
+                        help='Store each distinct frame once, with its duration')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int,
+                        default=1, help='Number of processes compositing pictures')
+    parser.add_argument('--max-builds', metavar='N', type=int, default=1,
+                        help='Number of movies of a batch built at the same time')
+    parser.add_argument('-c', '--cache', metavar='DIR',
+                        default=None, help='Directory of the frame cache')
+    parser.add_argument('--cache-size', metavar='MB', type=int,
+                        default=10240, help='Maximum size of the frame cache')
+    parser.add_argument('-b', '--build', metavar='DIR',
+                        default=None, help='Incremental build: directory of encoded sections')
+    parser.add_argument('-p', '--progress', action='store_true',
+                        default=False, help='Show the number of frames per second')
+    parser.add_argument('--chunks', metavar='N', type=int, default=1,
+                        help='Encode N chunks of the movie in parallel')
+    parser.add_argument('-w', '--workdir', metavar='DIR', default=None,
+                        help='Keep the frames in DIR to resume an interrupted build')
+    parser.add_argument('--encoders', metavar='N', type=int, default=1,
+                        help='Number of sections encoded while the next ones '
+                             'are rendered (with --build or --low-disk chunk)')
+    parser.add_argument('-f', '--frames', choices=sorted(FRAME_FORMATS), default='png',
+                        help='Format of the frames on disk: png-fast and png-none '
+                             'compress less, bmp, ppm and raw not at all')
+    parser.add_argument('--max-memory', metavar='MB', type=int, default=None,
+                        help='Memory of the frames in flight, for all the builds')
+    parser.add_argument('--preview', action='store_true', default=False,
+                        help='Fast build at a low resolution and frame rate')
+    parser.add_argument('--shards', metavar='DIR', default=None,
+                        help='Sharded build: queue of the shards and their segments')
+    parser.add_argument('--workers', metavar='N', type=int, default=1,
+                        help='Number of local workers of a sharded build, '
+                             '0 to only wait for other hosts')
+    parser.add_argument('--shard-frames', metavar='N', type=int, default=SHARD_FRAMES,
+                        help='Output frames per shard')
+    parser.add_argument('--worker', metavar='DIR', default=None,
+                        help='Render the shards of the queue in DIR, no CONF')
+    parser.add_argument('--dry-run', action='store_true',
+                        default=False, help='Count frames and disk space, then exit')
+    parser.add_argument('--low-disk', choices=('fail', 'stream', 'chunk'),
+                        default='fail',
+                        help='If the tmp dir is too small: fail, stream frames '
+                             'or encode section by section')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if args.debug:
         llevel = logging.DEBUG
     else:
         llevel = logging.INFO
-    logger = logging.getLogger()
-    logger.setLevel(llevel)
+    init_logging(llevel)
 
-    steam_handler = logging.StreamHandler()
-    steam_handler.setLevel(llevel)
-    logger.addHandler(steam_handler)
+    cache = None
+    if args.cache:
+        cache = FrameCache(args.cache, max_size=args.cache_size * 1024**2)
 
-    cwd = os.getcwd()
-    FPS = 25
-    correct_json_version = '0.1.1'
-    method = Image.BICUBIC
+    if args.worker:
+        run_worker(args.worker, tmp_dir=args.tmp, mode=args.mode, jobs=args.jobs,
+                   cache=cache, frame_format=args.frames)
+        return 0
+    if not args.conf:
+        parser.error('a configuration file is needed, except with --worker')
 
+    options = {'tmp_dir': args.tmp, 'mode': args.mode, 'low_disk': args.low_disk,
+               'chunks': args.chunks, 'dry_run': args.dry_run,
+               'progress': args.progress, 'encoders': args.encoders,
+               'frame_format': args.frames, 'preview': args.preview}
+    if args.max_memory:
+        options['budget'] = MemoryBudget(args.max_memory * 1024**2)
+    if len(args.conf) == 1:
+        try:
+            build(args.conf[0], jobs=args.jobs, cache=cache, build_dir=args.build,
+                  work_dir=args.workdir, shard_dir=args.shards, workers=args.workers,
+                  shard_frames=args.shard_frames, **options)
+        except Exception as err:
+            logger.error('%s failed: %s' % (args.conf[0], err), exc_info=args.debug)
+            return 1
+        return 0
 
-    import json
-    from collections import OrderedDict
+    if args.build or args.workdir or args.shards:
+        parser.error('--build, --workdir and --shards need a single configuration file')
+    with Scheduler(jobs=args.jobs, max_builds=args.max_builds, cache=cache,
+                   budget=options.pop('budget', None)) as scheduler:
+        results = scheduler.run(args.conf, **options)
+    failed = [conf_path for conf_path, result in results.items()
+              if isinstance(result, Exception)]
+    return 1 if failed else 0
 
-    root_dir = os.path.split(os.path.abspath(args.conf))[0]
-    logger.debug('root_dir: %s' % root_dir)
 
-    logger.info('Preparing...')
-    with open(args.conf, 'r') as jsonfile:
-        conf = json.load(jsonfile, object_pairs_hook=OrderedDict)
-        for section, value in conf.items():
-            if section == 'meta':
-                logger.debug('detected json version: ' + str(value['jsonversion']))
-                if not value['jsonversion'] == correct_json_version:
-                    #FIXME: look for a better exception
-                    raise ValueError('Your jsonfile does not look to be at the correct version')
-            if section == 'movie':
-                output = value['output']
-                resolution = (value['hor_resolution'], value['ver_resolution'])
-                vid = Video(resolution, tmp_dir=args.tmp)
-            if section == 'data':
-                for subsection, subvalue in value.items():
-                    logger.info('[' + subsection + ']')
-                    if subvalue['type'] == 'tex':
-                        duration = subvalue['duration']
-                        path = os.path.join(root_dir, subvalue['path'])
-                        number = FPS * duration
-                        vid.populate_with_slides(path, number)
-                    elif subvalue['type'] == 'image':
-                        path = os.path.join(root_dir, subvalue['path'])
-                        inifps = subvalue['inifps']
-                        speed = subvalue['speed']
-                        repeat = subvalue['repeat']
-                        number = FPS / inifps / speed
-                        vid.populate_with_pictures(path, number, repeat, method)
-                    else:
-                        raise ValueError('Wrong type')
-
-        vid.make(cwd, output=output, fps=FPS, resolution=resolution)
+if __name__ == '__main__':
+    sys.exit(main())